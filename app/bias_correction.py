@@ -0,0 +1,161 @@
+import os
+import shutil
+import fsspec
+import numpy as np
+import xarray as xr
+from dask.base import tokenize
+from utils import plan_chunks, select_time, write_zarr
+from grid_index import grid_index, lat_lon_names
+from telemetry import timed, count
+
+"""
+Gridded, out-of-core bias correction.
+
+Corrects the whole model field lazily, chunk by chunk, instead of the 1-d series of one location: the past-period
+statistics (climatologies or quantile tables) of model and reference are computed once per grid cell, mapped onto
+the model grid (nearest reference cell, see grid_index) and persisted, then applied to the future period as a lazy
+dask computation. Written to a '.zarr/' output location, the corrected field is computed one chunk at a time and any
+city or region can later be selected from the store without recomputing the correction.
+
+Methods ('bias_correction_method'):
+    delta               model + (reference past mean - model past mean)
+    relative_delta      model * (reference past mean / model past mean), keeps e.g. precipitation >= 0
+    quantile_mapping    empirical quantile mapping: adds the reference - model past difference at the quantile of each
+                        value ('quantile_levels' levels, default 101), constant beyond the past range so trends are kept
+
+Statistics are keyed by the dask token of the model and reference past periods (data sources, processing, window)
+and the method, so another future window, a rerun or another task with the same inputs reuses them.
+
+Configured from the environment:
+    CLIMATE_BC_STATISTICS_DIR   local directory or s3:// prefix of the persisted statistics
+                                (default ~/.cache/climate/bias_correction, 'statistics_location' parameter overrides it)
+"""
+
+STATISTICS_DIR = os.environ.get("CLIMATE_BC_STATISTICS_DIR", os.path.join(os.path.expanduser("~"), ".cache", "climate", "bias_correction"))
+METHODS = ["delta", "relative_delta", "quantile_mapping"]
+QUANTILE_LEVELS = 101
+
+
+def is_gridded(ds):
+    '''
+    whether ds still has lat/lon dimensions (as opposed to a point-selected series)
+    '''
+    lat_name, _ = lat_lon_names(ds)
+    return ds[lat_name].ndim > 0
+
+def time_layout(da):
+    '''
+    rechunk a dask-backed array for whole time series per chunk (needed for quantiles over time), see plan_chunks
+    '''
+    return da.chunk(plan_chunks(dict(da.sizes), da.dtype.itemsize, "time"))
+
+def past_statistics(past, method, quantiles):
+    '''
+    per grid cell mean (delta methods) or quantile table (quantile mapping) of a past period
+    '''
+    if method == "quantile_mapping":
+        if past.chunks is not None:
+            past = time_layout(past)
+        return past.quantile(quantiles, dim='time', skipna=True)
+    return past.mean('time', skipna=True)
+
+def to_model_grid(statistics, model):
+    '''
+    nearest-cell remap of reference statistics onto the grid of model (unchanged on the same grid)
+    '''
+    model_index, reference_index = grid_index(model), grid_index(statistics)
+    if model_index is reference_index:
+        return statistics
+    cells, _ = reference_index.query(model_index.lat, model_index.lon)
+    statistics = statistics.reset_coords(drop=True).drop_vars([dim for dim in cells if dim in statistics.coords])
+    statistics = statistics.rename({dim: "reference_" + dim for dim in cells})
+    indexers = {"reference_" + dim: xr.DataArray(positions.reshape(model_index.shape), dims=model_index.dims) for dim, positions in cells.items()}
+    lat_name, lon_name = lat_lon_names(model)
+    return statistics.isel(indexers).assign_coords({lat_name: model[lat_name], lon_name: model[lon_name]})
+
+def statistics_store(model_past, reference_past, method, quantiles, location=None):
+    key = tokenize(model_past, reference_past, method, list(quantiles) if method == "quantile_mapping" else None)
+    return "{}/{}-{}.zarr".format((location or STATISTICS_DIR).rstrip('/'), method, key)
+
+@timed
+def correction_statistics(model_past, reference_past, method, quantiles, location=None):
+    '''
+    Dataset of the past statistics of 'model' and 'reference' on the model grid,
+    loaded from the statistics location if they were computed before, else computed and persisted there
+    (statistics of point series are only computed in memory)
+    '''
+    if not is_gridded(model_past):
+        return xr.Dataset({"model": past_statistics(model_past, method, quantiles).reset_coords(drop=True),
+                           "reference": past_statistics(reference_past, method, quantiles).reset_coords(drop=True)})
+
+    store = statistics_store(model_past, reference_past, method, quantiles, location)
+    fs, path = fsspec.core.url_to_fs(store)
+    if fs.exists(path + "/.zmetadata") or fs.exists(path + "/zarr.json"): # zarr format 2 / 3
+        print("Loading {} bias-correction statistics from {}".format(method, store))
+        count("bias_statistics_hits", 1)
+        return xr.open_zarr(store, consolidated=True)
+
+    count("bias_statistics_misses", 1)
+    print("Computing {} bias-correction statistics, saving to {}".format(method, store))
+    statistics = xr.Dataset({"model": past_statistics(model_past, method, quantiles),
+                             "reference": to_model_grid(past_statistics(reference_past, method, quantiles), model_past)})
+    if "://" in store:
+        # consolidated metadata is written last, so an interrupted write is recomputed next time
+        write_zarr(statistics, store)
+    else:
+        tmp_path = "{}.tmp-{}".format(path, os.getpid())
+        write_zarr(statistics, tmp_path)
+        try:
+            os.replace(tmp_path, path)
+        except OSError: # written concurrently by another process
+            shutil.rmtree(tmp_path, ignore_errors=True)
+    return xr.open_zarr(store, consolidated=True)
+
+def map_quantiles(values, model_quantiles, reference_quantiles):
+    '''
+    empirical quantile mapping of values (..., time) with the quantile tables (..., quantile) of the same cells:
+    adds reference - model quantile difference interpolated at each value, constant beyond the tables
+    '''
+    shape = np.broadcast(values[..., 0], model_quantiles[..., 0], reference_quantiles[..., 0]).shape
+    values = np.broadcast_to(values, shape + values.shape[-1:]).reshape(-1, values.shape[-1])
+    model_quantiles = np.broadcast_to(model_quantiles, shape + model_quantiles.shape[-1:]).reshape(-1, model_quantiles.shape[-1])
+    reference_quantiles = np.broadcast_to(reference_quantiles, shape + reference_quantiles.shape[-1:]).reshape(-1, reference_quantiles.shape[-1])
+
+    corrected = np.full(values.shape, np.nan, dtype=values.dtype)
+    for cell in range(values.shape[0]):
+        table = model_quantiles[cell]
+        valid = ~np.isnan(table) & ~np.isnan(reference_quantiles[cell])
+        if valid.any(): # no data at the cell (e.g. masked ocean) stays nan
+            corrected[cell] = values[cell] + np.interp(values[cell], table[valid], (reference_quantiles[cell] - table)[valid])
+    return corrected.reshape(shape + values.shape[-1:])
+
+def apply_correction(model_future, statistics, method):
+    '''
+    lazily bias-correct model_future with the statistics of correction_statistics
+    '''
+    assert method in METHODS, "Unknown bias correction method {}, options: {}".format(method, METHODS)
+    if method == "delta":
+        return model_future + (statistics.reference - statistics.model)
+    if method == "relative_delta":
+        # cells without model signal (e.g. a dry past) are left uncorrected
+        return model_future * xr.where(statistics.model != 0, statistics.reference / statistics.model, 1)
+    if model_future.chunks is not None:
+        model_future = time_layout(model_future)
+    corrected = xr.apply_ufunc(map_quantiles, model_future, statistics.model, statistics.reference,
+                               input_core_dims=[['time'], ['quantile'], ['quantile']], output_core_dims=[['time']],
+                               dask='parallelized', output_dtypes=[model_future.dtype])
+    return corrected.transpose(*model_future.dims)
+
+def correct_field(model, reference, past, future, method, variable="tas", quantile_levels=QUANTILE_LEVELS, location=None):
+    '''
+    bias-correct variable of the (calendar-processed, see process_models) model over the future window against
+    the reference over the past window, model and reference may be on different grids
+    returns the lazy corrected Dataset on the model grid
+    '''
+    quantiles = np.linspace(0, 1, int(quantile_levels))
+    model_past = select_time(model[variable], *past)
+    reference_past = select_time(reference[variable], *past)
+    statistics = correction_statistics(model_past, reference_past, method, quantiles, location)
+
+    corrected = apply_correction(select_time(model[variable], *future), statistics, method)
+    return corrected.to_dataset(name=variable).assign_attrs(bias_correction_method=method, past_period="{}/{}".format(*past))
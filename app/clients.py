@@ -0,0 +1,41 @@
+import os
+import threading
+import boto3
+from botocore.config import Config
+
+"""
+Process-wide pool of S3 clients.
+
+Creating a boto3 client or resource is slow (credential and endpoint resolution), so one S3 client, with a connection
+pool sized for the upload and download threads, is shared by the whole process (clients are thread-safe).
+Resources (bucket listings) are not thread-safe: one is kept per thread and reused by every Data object.
+
+Configured from the environment:
+    S3_MAX_POOL_CONNECTIONS     connection pool size of the shared client
+                                (default 2 x S3_UPLOAD_CONCURRENCY + S3_DOWNLOAD_CONCURRENCY)
+"""
+
+S3_MAX_POOL_CONNECTIONS = int(os.environ.get("S3_MAX_POOL_CONNECTIONS",
+    2 * int(os.environ.get("S3_UPLOAD_CONCURRENCY", 8)) + int(os.environ.get("S3_DOWNLOAD_CONCURRENCY", 16))))
+
+_client = None
+_client_lock = threading.Lock()
+_local = threading.local()
+
+def s3_client():
+    '''
+    process-wide S3 client
+    '''
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = boto3.client("s3", config=Config(max_pool_connections=max(10, S3_MAX_POOL_CONNECTIONS)))
+        return _client
+
+def s3_resource():
+    '''
+    S3 resource of the calling thread
+    '''
+    if getattr(_local, "resource", None) is None:
+        _local.resource = boto3.session.Session().resource("s3")
+    return _local.resource
@@ -1,6 +1,9 @@
-from utils import process_models, no_correction, delta_correction, reordering_cost, select_location_mdf
+from utils import select_region, select_time, time_series_chunks, process_models, select_locations_mdf, no_correction, delta_correction, reordering_cost, reordering_costs, compare_reorderings, select_location_mdf
 import numpy as np
 import xarray as xr
+from data import Data, DataLocationType, DataType
+from bias_correction import correct_field, QUANTILE_LEVELS
+from quantile_sketch import sketch_array, DEFAULT_K
 
 def process_data(parameters):
     '''
@@ -17,6 +20,27 @@ def process_data(parameters):
 
     return [processed_data]
 
+def ingest_to_zarr(parameters):
+    '''
+    convert a model or reference dataset into a store chunked for time-series access
+    (output location should end in '.zarr/'), later runs read it as a 'zarr' input
+    '''
+    print("Ingesting dataset to Zarr...")
+
+    model_data = parameters["model"].df
+    chunked_data = time_series_chunks(model_data, parameters.get("space_chunk"))
+
+    return [chunked_data]
+
+def series_quantiles(series, q, parameters):
+    '''
+    quantiles q of a series, from the optional "quantile_method" parameter:
+    'exact' (default, np.quantile) or 'sketch' (streamed through a KLL sketch with "sketch_k" items per level, see quantile_sketch)
+    '''
+    if parameters.get("quantile_method", "exact") == "sketch":
+        return sketch_array(series, parameters.get("sketch_k", DEFAULT_K)).quantile(q)
+    return np.quantile(series.values, q)
+
 def select_location_and_quantiles(parameters):
     '''
     Select time series by location and time ranges specified in parameters
@@ -33,14 +57,51 @@ def select_location_and_quantiles(parameters):
 
     selected_data = select_location_mdf(model_data, location, start, end)
     #quantiles = quantiles(model_data, location, start, end)
-    q=[0,0.9]
-    quantiles = np.quantile(selected_data.tas.values, q)
+    q = parameters.get("quantiles", [0, 0.9])
+    quantiles = series_quantiles(selected_data.tas, q, parameters)
+    return [selected_data, quantiles]
+
+def select_locations_and_quantiles(parameters):
+    '''
+    Select time series for a list of locations at once (vectorized over locations)
+    returns a Dataset with a 'location' dimension and {location: quantiles}
+    '''
+    model_data = parameters["model"].df
+
+    start = parameters["start"] # np.datetime64
+    end = parameters["end"]
+    locations = parameters['location']
+
+    print("Selecting {} locations...".format(len(locations)))
+
+    selected_data = select_locations_mdf(model_data, locations, start, end).load()
+    q = parameters.get("quantiles", [0, 0.9])
+    quantiles = {location: series_quantiles(selected_data.tas.sel(location=location), q, parameters) for location in locations}
     return [selected_data, quantiles]
 
+def region_quantiles(parameters):
+    '''
+    quantiles of the model field over a region and time range in one streaming pass (one sketch per dask chunk, merged)
+    optional 'region': [lat_min, lat_max, lon_min, lon_max] (default: the whole grid)
+    returns the sketch as a Dataset (can be merged with the sketches of other runs, see quantile_sketch) and the quantiles
+    '''
+    model_data = parameters["model"].df
+    region = parameters.get("region")
+    field = select_time(model_data, parameters.get("start"), parameters.get("end"))
+    if region is not None:
+        field = select_region(field, region)
+
+    print("Sketching quantiles over region {}...".format(region or "(whole grid)"))
+    sketch = sketch_array(field[parameters.get("variable", "tas")], parameters.get("sketch_k", DEFAULT_K))
+    q = parameters.get("quantiles", [0, 0.9])
+    quantiles = sketch.quantile(q)
+    print("Quantiles {} of {} values: {} (rank error < {:.2%})".format(q, sketch.n, quantiles, sketch.rank_error))
+    return [sketch.to_dataset(), quantiles]
+
 def apply_bias_correction(parameters):
     '''
     takes bias-correction method specified in parameters
-    options: 'none', 'delta', tbc...
+    options: 'none', 'delta', 'relative_delta', 'quantile_mapping' (see bias_correction)
     '''
 
     model_data = parameters['model'].df
@@ -57,27 +118,41 @@ def apply_bias_correction(parameters):
     elif bias_correction_method=="delta":
         bias_corrected_model, bias_correction_reference = delta_correction(model_data, reference, past, future)
 
-    #elif etc.
+    elif bias_correction_method in ["relative_delta", "quantile_mapping"]:
+        corrected = correct_field(model_data, reference, past, future, bias_correction_method,
+                                  quantile_levels=parameters.get("quantile_levels", QUANTILE_LEVELS))
+        bias_corrected_model = corrected.tas
+        bias_correction_reference = reference.loc[dict(time=slice(future[0],future[1]))].tas
 
     return [bias_corrected_model, bias_correction_reference]
 
-def calculate_cost(parameters):
+def gridded_bias_correction(parameters):
     '''
-    apply reordering algorithm (see ref: ...)
-    and calculate cost metric for specified extreme (upper/lower) threshold
+    bias-correct the whole model field over the future window, lazily and chunk by chunk (see bias_correction)
+    options: 'delta', 'relative_delta', 'quantile_mapping'
+    the output location should end in '.zarr/', later runs select locations from it as a 'zarr' input
     '''
+    print("Bias-correcting gridded model data...")
+
+    model_data = parameters['model'].df # calendar-processed, see ProcessData
+    reference = parameters["reference"].df
+
+    corrected = correct_field(model_data, reference, parameters['past'], parameters['future'],
+                              parameters['bias_correction_method'], parameters.get('variable', 'tas'),
+                              parameters.get('quantile_levels', QUANTILE_LEVELS), parameters.get('statistics_location'))
+    return [corrected]
 
+def matched_series(parameters):
+    '''
+    return reference (A) and model (B) value arrays shortened to equal length
+    '''
     # these should generally be bias_corrected_model, bias_correction_reference from previous task
     model_data = parameters['model'].df
     reference = parameters['reference'].df
 
-    window = parameters["window"]
-    threshold = parameters["threshold"]
-    threshold_type = parameters["threshold_type"] #'upper'/'lower'/'none'
-
     A = reference.values#[start:stop]
     B = model_data.values#[start:stop]  # A is fixed, B is reordered
-    
+
     print("Lengths of Reference(A) and Model(B) arrays here: A:{} B:{}".format(len(A), len(B)))
     if len(A) != len(B):
         if len(A) < len(B):
@@ -87,11 +162,92 @@ def calculate_cost(parameters):
             A = A[:len(B)]
             print("A shortened to be equal to B.")
     # at some point this should account for more other variables than tas...
+    return A, B
 
-    
-    cost, reordered = reordering_cost(A, B, window, threshold, threshold_type)
+def reorder_method(parameters, A, B, thresholds):
+    '''
+    reorder solver from the optional "reorder_mode" parameter:
+    'exact' (default), 'chunked' (approximate, parallel) or 'check' (run both, report the difference)
+    '''
+    reorder_mode = parameters.get("reorder_mode", "exact")
+    if reorder_mode == "check":
+        for threshold in thresholds:
+            print("Reordering check: {}".format(compare_reorderings(A, B, parameters["window"], threshold, parameters["threshold_type"])))
+    return "chunked" if reorder_mode == "chunked" else "auto"
+
+def calculate_cost(parameters):
+    '''
+    apply reordering algorithm (see ref: ...)
+    and calculate cost metric for specified extreme (upper/lower) threshold
+    '''
+    window = parameters["window"]
+    threshold = parameters["threshold"]
+    threshold_type = parameters["threshold_type"] #'upper'/'lower'/'none'
+
+    A, B = matched_series(parameters)
+
+    method = reorder_method(parameters, A, B, [threshold])
+    cost_metric = parameters.get("cost_metric", "rms") #'rms'/'edit'
+    tolerance = parameters.get("edit_tolerance", 0.)
+    cost, reordered = reordering_cost(A, B, window, threshold, threshold_type, method, cost_metric, tolerance)
     return [cost, reordered]
 
+def calculate_costs_thresholds(parameters):
+    '''
+    apply reordering algorithm once for the window
+    and calculate cost metric for each of a list of thresholds
+    '''
+    window = parameters["window"]
+    thresholds = parameters["thresholds"]
+    threshold_type = parameters["threshold_type"] #'upper'/'lower'/'none'
+
+    A, B = matched_series(parameters)
+
+    method = reorder_method(parameters, A, B, thresholds)
+    cost_metric = parameters.get("cost_metric", "rms") #'rms'/'edit'
+    tolerance = parameters.get("edit_tolerance", 0.)
+    costs, reordered = reordering_costs(A, B, window, thresholds, threshold_type, method, cost_metric, tolerance)
+    return [costs, reordered]
+
+def location_costs(parameters):
+    '''
+    bias-correction + reordering costs for one location, for every window and threshold
+    (model, reference: 1-d series of the location as Data objects), used by the batch mode
+    returns [(window, costs, reordered), ...]
+    '''
+    bc_output = apply_bias_correction(parameters)
+    parameters = dict(parameters)
+    parameters['model'] = Data(DataType.MDF, DataLocationType.LOCAL, df=bc_output[0])
+    parameters['reference'] = Data(DataType.MDF, DataLocationType.LOCAL, df=bc_output[1])
+
+    window_outputs = []
+    for window in parameters["windows"]:
+        parameters['window'] = window
+        costs, reordered = calculate_costs_thresholds(parameters)
+        window_outputs.append((window, costs, reordered))
+    return window_outputs
+
+# task registry: task name (as used in run_task / the service_name) -> task function
+TASKS = {
+    "ProcessData": process_data,
+    "SelectLocation": select_location_and_quantiles,
+    "SelectLocations": select_locations_and_quantiles,
+    "BiasCorrection": apply_bias_correction,
+    "CalculateCosts": calculate_cost,
+    "CalculateCostsThresholds": calculate_costs_thresholds,
+    "LocationCosts": location_costs,
+    "IngestZarr": ingest_to_zarr,
+    "GriddedBiasCorrection": gridded_bias_correction,
+    "RegionQuantiles": region_quantiles,
+    # "AggregateModels": aggregate_models,
+}
+
+def register_task(name, task):
+    '''
+    add a task function (parameters -> list of outputs) to the registry
+    '''
+    TASKS[name] = task
+
 ######## disregard tasks requiring multi model input for now
 # def compute_disruption_days(models, parameters):
 #     '''
@@ -0,0 +1,102 @@
+import os
+import time
+from contextlib import contextmanager
+
+"""
+Optional local dask.distributed cluster sized to the container.
+
+Enabled with the 'dask_cluster' parameter (or CLIMATE_DASK_CLUSTER=1). The number of workers and their memory
+limits are derived from the CPU / memory limits of the container (cgroup, e.g. the ECS task's 8 vCPU / 60 GB),
+so gridded computations spill to disk or pause instead of exceeding the task memory limit.
+A dask performance report (task stream, profile, bandwidth) is written for every run.
+
+Parameters (all optional):
+    dask_cluster                true to run dask computations on the local cluster
+    dask_workers                number of worker processes (default: one per 2 CPUs)
+    dask_threads_per_worker     threads per worker (default 2)
+    dask_memory_fraction        fraction of the container memory given to the workers (default 0.75, the rest is left
+                                for the main process, which holds the loaded series and runs the pipeline)
+
+Configured from the environment:
+    CLIMATE_DASK_CLUSTER        '1' to enable the cluster without the parameter
+    CLIMATE_DASK_REPORT_DIR     directory of the performance reports (default: working directory)
+    CLIMATE_DASK_DASHBOARD      dashboard address (default ':8787')
+"""
+
+DASK_REPORT_DIR = os.environ.get("CLIMATE_DASK_REPORT_DIR", ".")
+DASK_DASHBOARD = os.environ.get("CLIMATE_DASK_DASHBOARD", ":8787")
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def container_cpus():
+    '''
+    CPUs available to the container: cgroup v2 / v1 CPU quota, else the CPUs the process may run on
+    '''
+    available = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    quota = None
+    cpu_max = _read("/sys/fs/cgroup/cpu.max") # v2: '<quota> <period>' or 'max <period>'
+    if cpu_max and not cpu_max.startswith("max"):
+        limit, period = cpu_max.split()
+        quota = int(limit) / int(period)
+    else:
+        limit, period = _read("/sys/fs/cgroup/cpu/cpu.cfs_quota_us"), _read("/sys/fs/cgroup/cpu/cpu.cfs_period_us") # v1
+        if limit and period and int(limit) > 0:
+            quota = int(limit) / int(period)
+    return max(1, min(available, int(quota))) if quota else available
+
+def container_memory():
+    '''
+    memory available to the container in bytes: cgroup v2 / v1 limit, else the physical memory
+    '''
+    physical = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    for path in ["/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"]:
+        limit = _read(path)
+        if limit and limit.isdigit():
+            return min(physical, int(limit))
+    return physical
+
+def cluster_shape(parameters):
+    '''
+    (workers, threads per worker, memory limit per worker in bytes) for the container
+    '''
+    cpus = container_cpus()
+    threads = int(parameters.get('dask_threads_per_worker', min(2, cpus)))
+    workers = int(parameters.get('dask_workers', max(1, cpus // threads)))
+    memory = int(container_memory() * float(parameters.get('dask_memory_fraction', 0.75)) / workers)
+    return workers, threads, memory
+
+def cluster_enabled(parameters):
+    return bool(parameters.get('dask_cluster', os.environ.get("CLIMATE_DASK_CLUSTER", "0") not in ("", "0")))
+
+@contextmanager
+def dask_cluster(parameters):
+    '''
+    run the block on a local dask cluster (and write its performance report) if enabled in parameters,
+    yields the dask Client or None
+    '''
+    if not cluster_enabled(parameters):
+        yield None
+        return
+
+    from dask.distributed import LocalCluster, Client, performance_report
+
+    workers, threads, memory = cluster_shape(parameters)
+    print("Starting local dask cluster: {} workers x {} threads, {:.1f} GB memory each".format(workers, threads, memory / 1024**3))
+    cluster = LocalCluster(n_workers=workers, threads_per_worker=threads, memory_limit=memory, dashboard_address=DASK_DASHBOARD)
+    client = Client(cluster)
+    print("Dask dashboard: {}".format(client.dashboard_link))
+
+    os.makedirs(DASK_REPORT_DIR, exist_ok=True)
+    report = os.path.join(DASK_REPORT_DIR, "dask-report-{}.html".format(time.strftime("%Y%m%d-%H%M%S")))
+    try:
+        with performance_report(filename=report):
+            yield client
+        print("Dask performance report: {}".format(report))
+    finally:
+        client.close()
+        cluster.close()
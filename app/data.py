@@ -1,17 +1,24 @@
 
 
-from utils import download_s3_folder, import_dataset, get_local_directory
+from utils import import_dataset, import_remote_dataset, import_zarr, get_local_directory
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import numpy as np
-import boto3
 from enum import Enum
+from clients import s3_resource
+from dataset_cache import fetch_folder
+from telemetry import stage, describe
 
 class DataType(Enum):
     MDF="model"
     CSV='df'
+    ZARR='zarr' # point-series store written by the IngestZarr task
 
 class DataLocationType(Enum):
     S3="s3"
+    S3_LAZY="s3-lazy" # read in place, only the byte ranges that are used
     KAFKA="kafka"
     LOCAL="local"
     ESGF='esgf'
@@ -20,40 +27,100 @@ class Data:
     """
     This class contains logic that handles the actual downloading / uploading of data to respective data sources.
     The Data object is standardized across all Hypervisor use locations, client, container, and server.
+    Data objects are lazy handles: nothing is fetched until df is first accessed (or load() is called),
+    so inputs a task never uses are never downloaded, and release() frees the memory of loaded data.
     """
-    def __init__(self, dtype, data_location, s3_key=None, s3_bucket_name=None,  path=None, df=None):
+    def __init__(self, dtype, data_location, s3_key=None, s3_bucket_name=None,  path=None, df=None, coords=None, variables=None, layout=None):
         self.path = path
+        self.coords = coords # optional (lat, lon): only read the nearest grid cell
+        self.variables = variables # optional list of variables to read (S3_LAZY only)
+        self.layout = layout # optional chunk layout 'time' / 'space' for gridded data, see utils.plan_chunks
         self.dtype = dtype
-        self.df = df
+        self._df = df
+        self._lock = threading.Lock()
+        self._cache_lease = None # keeps a folder of the dataset cache from being evicted while the data is used (closed on release() or garbage collection)
         self.data_location = data_location
         self.s3_key = s3_key
         self.s3_bucket_name = s3_bucket_name
         self.directory = get_local_directory()
-        print("Data properties:", self.path, self.dtype, self.data_location, self.s3_key, self.s3_bucket_name)
+        print("Data properties:", self.path, self.dtype, self.data_location, self.s3_key, self.s3_bucket_name, self.coords)
 
-        if self.data_location == DataLocationType.S3:
-            self.s3 = boto3.resource("s3")
-            
-            # S3 bucket identifier
-            self.s3_bucket = self.s3.Bucket(name=self.s3_bucket_name)
-        else:
-            pass
+    @property
+    def s3(self):
+        # shared per thread, see clients
+        return s3_resource()
+
+    @property
+    def s3_bucket(self):
+        return self.s3.Bucket(name=self.s3_bucket_name)
+
+    @property
+    def df(self):
+        '''
+        the data, fetched / opened on first access
+        '''
+        if self._df is None and self.data_location != DataLocationType.LOCAL:
+            self.load()
+        return self._df
+
+    @df.setter
+    def df(self, df):
+        self._df = df
+
+    @property
+    def loaded(self):
+        return self._df is not None
+
+    def load(self):
+        '''
+        load the data now instead of on first access (e.g. to prefetch it in the background), returns self
+        '''
+        with self._lock:
+            if self._df is None and self.data_location != DataLocationType.LOCAL:
+                with stage("load", key=self.s3_key):
+                    self._load_data()
+        return self
+
+    def release(self):
+        '''
+        drop the loaded data to free its memory, remote data is loaded again on the next access
+        '''
+        with self._lock:
+            self._df = None
+            if self._cache_lease is not None:
+                self._cache_lease.close()
+                self._cache_lease = None
 
-        self._load_data()
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state["_lock"]
+        state["_cache_lease"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
 
     def _load_data(self):
+        if self.data_location == DataLocationType.LOCAL:
+            # already in memory (e.g. output of a previous task)
+            return
         data_object = self._load_object()
         if self.dtype == DataType.CSV:
             self.df = self._object_to_pandas(data_object)
-        elif self.dtype == DataType.MDF:
+        elif self.dtype in [DataType.MDF, DataType.ZARR]:
             self.df = data_object
-        print("Loaded object: {}".format(self.df))
+        print("Loaded object: {}".format(describe(self.df)))
         
     def _load_object(self):
         if self.data_location == DataLocationType.S3:
             print("Loading data from S3 bucket: {} Key: {}".format(self.s3_bucket_name, self.s3_key))
             data_object = self._load_object_from_s3()
             return data_object
+        elif self.data_location == DataLocationType.S3_LAZY:
+            print("Opening data in place from S3 bucket: {} Key: {}".format(self.s3_bucket_name, self.s3_key))
+            data_object = self._load_object_from_s3_lazy()
+            return data_object
         elif self.data_location == DataLocationType.ESGF:
             print("Loading data from ESGF bucket")
             # TODO implement this using the lazy loaders and selecting down to location and only relevant factors fir
@@ -65,8 +132,13 @@ class Data:
 
     def _load_object_from_s3(self):
         if self.dtype ==  DataType.MDF:
-            download_s3_folder(self.s3_bucket, self.s3_key, local_dir=self.s3_key)
-            return import_dataset(self.directory, self.s3_key)
+            # downloaded once per host into the shared dataset cache
+            path, self._cache_lease = fetch_folder(self.s3_bucket, self.s3_key)
+            return import_dataset(os.path.dirname(path), os.path.basename(path), self.coords, self.layout)
+
+        if self.dtype == DataType.ZARR:
+            # read in place, only the chunks touched by later selections are fetched
+            return import_zarr("s3://{}/{}".format(self.s3_bucket_name, self.s3_key), self.coords)
 
         if self.dtype ==  DataType.CSV:
             
@@ -77,6 +149,18 @@ class Data:
             print("Retrieved object from S3 {} Body:,".format(response['Body']))
             return response['Body']
 
+    def _load_object_from_s3_lazy(self):
+        uri = "s3://{}/{}".format(self.s3_bucket_name, self.s3_key)
+        if self.dtype == DataType.MDF:
+            return import_remote_dataset(uri, self.coords, self.variables, self.layout)
+
+        if self.dtype == DataType.ZARR:
+            return import_zarr(uri, self.coords, cache=True)
+
+        if self.dtype == DataType.CSV:
+            # read_csv opens s3:// uris through s3fs
+            return uri
+
     def _object_to_pandas(self, data_object):
         df = pd.read_csv(data_object)
         return df
@@ -91,6 +175,16 @@ class Data:
         string += "\t Data Type {}".format(self.dtype)
         string += "\t Data Location Type {}".format(self.data_location)
         string += "\n S3 Location s3://{}/{}".format(self.s3_bucket_name, self.s3_key)
-        string += "\n Data: {}".format(self.df)
+        string += "\n Data: {}".format(describe(self._df) if self.loaded else "(not loaded)")
 
         return string
+
+
+def prefetch(values):
+    '''
+    load the remote Data objects among values concurrently (e.g. the inputs of a task about to run, so their downloads overlap)
+    '''
+    pending = [value for value in values if isinstance(value, Data) and not value.loaded and value.data_location != DataLocationType.LOCAL]
+    if len(pending) > 1:
+        with ThreadPoolExecutor(max_workers=len(pending), thread_name_prefix="prefetch") as pool:
+            list(pool.map(Data.load, pending))
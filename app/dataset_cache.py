@@ -0,0 +1,183 @@
+import os
+import json
+import time
+import fcntl
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from utils import download_s3_folder, evict_lru
+from telemetry import count
+
+"""
+Node-level shared cache of the datasets downloaded from S3.
+
+S3 folders (model / reference NetCDF files) are downloaded into CLIMATE_DATASET_CACHE_DIR, e.g. a volume mounted into
+every task on the same host, and reused by later tasks and runs:
+- fills are atomic: files are downloaded to '.part' files and renamed (see download_s3_folder), and a folder is only
+  used as complete once its manifest is written, so an interrupted fill is resumed by the next task
+- one file lock per folder: tasks using a complete folder share it, a task filling a missing or partial folder locks
+  it exclusively, so concurrent tasks needing it wait for the one downloading it instead of downloading it again
+- a task using a folder holds a shared lock on it so it is never evicted underneath it, until the Data using it is
+  released or garbage-collected, or the task run ends (see task_leases)
+- complete folders are read without contacting S3 (CLIMATE_DATASET_CACHE_REVALIDATE=1 compares them with S3 first,
+  re-downloading changed files only)
+- the cache is capped at CLIMATE_DATASET_CACHE_MAX_GB, least-recently-used folders are evicted (see utils.evict_lru)
+- hits, misses and downloaded bytes are counted in the run metrics (see telemetry)
+
+Configured from the environment:
+    CLIMATE_DATASET_CACHE_DIR           cache directory (default ~/.cache/climate/datasets)
+    CLIMATE_DATASET_CACHE_MAX_GB        size cap (default 160, leaving room within the 200 GiB ephemeralStorage of
+                                        rmets_task_def.yaml for the task cache and outputs)
+    CLIMATE_DATASET_CACHE_REVALIDATE    '1' to check cached folders against S3 before using them
+"""
+
+DATASET_CACHE_DIR = os.environ.get("CLIMATE_DATASET_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "climate", "datasets"))
+DATASET_CACHE_MAX_BYTES = int(float(os.environ.get("CLIMATE_DATASET_CACHE_MAX_GB", 160)) * 1024**3)
+DATASET_CACHE_REVALIDATE = os.environ.get("CLIMATE_DATASET_CACHE_REVALIDATE", "0") not in ("", "0")
+
+MANIFEST = ".complete.json"
+LOCK_DIR = ".locks"
+
+
+def entry_name(bucket_name, s3_folder):
+    '''
+    cache folder name of an S3 folder, e.g. 'climate-ensembling--cmip6--EC-Earth3'
+    '''
+    return "{}/{}".format(bucket_name, s3_folder).strip('/').replace('/', '--')
+
+def open_lock(name):
+    os.makedirs(os.path.join(DATASET_CACHE_DIR, LOCK_DIR), exist_ok=True)
+    return open(os.path.join(DATASET_CACHE_DIR, LOCK_DIR, name + ".lock"), 'a')
+
+def try_exclusive_lock(path):
+    '''
+    exclusive lock of a cache folder if no other task is filling or using it, else None
+    '''
+    lock = open_lock(os.path.basename(path))
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        return None
+    return lock
+
+def is_complete(path):
+    return os.path.exists(os.path.join(path, MANIFEST))
+
+class Lease:
+    '''
+    use of a cache folder by this process: the process holds a shared lock on the folder until every lease is closed,
+    leases are closed when they are garbage-collected
+    '''
+    def __init__(self, name, entry):
+        self.name = name
+        self.entry = entry
+        self.closed = False
+
+    def close(self):
+        with _leases_lock:
+            if self.closed:
+                return
+            self.closed = True
+            if _leases.get(self.name) is not self.entry: # already released by task_leases
+                return
+            self.entry["users"] -= 1
+            if self.entry["users"] == 0:
+                self.entry["lock"].close()
+                del _leases[self.name]
+
+    def __del__(self):
+        self.close()
+
+# name -> {"lock": file holding the shared lock, "users": open leases}, file locks are per open file,
+# so the folders this process holds are tracked here instead of being locked again (which would deadlock)
+_leases = {}
+_leases_lock = threading.RLock() # re-entrant: a lease may be garbage-collected while the lock is held
+_fill_locks = defaultdict(threading.Lock)
+
+def _lease(name):
+    with _leases_lock:
+        if name not in _leases:
+            return None
+        _leases[name]["users"] += 1
+        return Lease(name, _leases[name])
+
+def release_leases():
+    '''
+    close every lease of this process, leases closed later are ignored
+    '''
+    with _leases_lock:
+        for entry in _leases.values():
+            entry["lock"].close()
+        _leases.clear()
+
+@contextmanager
+def task_leases():
+    '''
+    scope of a task run: the cache folders it used can be evicted once it ends, even if its Data is still referenced
+    '''
+    try:
+        yield
+    finally:
+        release_leases()
+
+def fill(lock, bucket, s3_folder, path):
+    '''
+    download a missing or partial folder under an exclusive lock, lock is shared again when it returns
+    '''
+    # converting a shared flock to exclusive is not atomic, another task may have filled the folder meanwhile
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    try:
+        if is_complete(path) and not DATASET_CACHE_REVALIDATE:
+            count("dataset_cache_hits", 1)
+            print("Dataset cache hit: s3://{}/{} at {} (filled by another task)".format(bucket.name, s3_folder, path))
+            return
+        count("dataset_cache_misses", 1)
+        print("Dataset cache miss: s3://{}/{}, downloading to {}".format(bucket.name, s3_folder, path))
+        os.makedirs(path, exist_ok=True)
+        downloaded_bytes = download_s3_folder(bucket, s3_folder, local_dir=path)
+        manifest = os.path.join(path, MANIFEST)
+        with open(manifest + ".part", 'w') as f:
+            json.dump({"s3": "s3://{}/{}".format(bucket.name, s3_folder), "filled": time.time(), "downloaded_bytes": downloaded_bytes}, f)
+        os.replace(manifest + ".part", manifest)
+    finally:
+        fcntl.flock(lock, fcntl.LOCK_SH)
+
+def fetch_folder(bucket, s3_folder):
+    '''
+    local copy of an S3 folder in the shared cache, downloaded unless a complete copy is cached
+    returns (path, lease): the folder is not evicted until the lease is closed
+    '''
+    name = entry_name(bucket.name, s3_folder)
+    path = os.path.join(DATASET_CACHE_DIR, name)
+    with _fill_locks[name]:
+        lease = _lease(name)
+        if lease is not None:
+            count("dataset_cache_hits", 1)
+            print("Dataset cache hit: s3://{}/{} at {} (in use by this task)".format(bucket.name, s3_folder, path))
+            return path, lease
+
+        lock = open_lock(name)
+        try:
+            # complete folders are shared by every task using them, only filling one needs it exclusively
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            if is_complete(path) and not DATASET_CACHE_REVALIDATE:
+                count("dataset_cache_hits", 1)
+                print("Dataset cache hit: s3://{}/{} at {}".format(bucket.name, s3_folder, path))
+            else:
+                fill(lock, bucket, s3_folder, path)
+            os.utime(path) # mark as recently used
+        except BaseException:
+            lock.close()
+            raise
+        with _leases_lock:
+            entry = _leases[name] = {"lock": lock, "users": 1}
+
+    evict()
+    return path, Lease(name, entry)
+
+def evict():
+    '''
+    remove least-recently-used folders no task is using until the cache is below DATASET_CACHE_MAX_BYTES
+    '''
+    return evict_lru(DATASET_CACHE_DIR, DATASET_CACHE_MAX_BYTES, acquire=try_exclusive_lock)
@@ -0,0 +1,140 @@
+import os
+import pickle
+import hashlib
+import numpy as np
+import xarray as xr
+from scipy.spatial import cKDTree
+
+"""
+Nearest-grid-cell index on the sphere.
+
+The grid cells of a dataset are put in a KD-tree on their unit-sphere (x, y, z) positions, so nearest-cell lookups
+are correct for any longitude convention (-180..180 or 0..360), across the dateline and near the poles, and work on
+curvilinear grids (2-d lat/lon coordinates, e.g. rotated-pole or tripolar ocean grids) as well as regular lat/lon grids.
+
+An index is built once per grid: it is kept in memory and persisted to CLIMATE_GRID_INDEX_DIR keyed by a hash
+of the grid's coordinates, so the next run (or model with the same grid) loads it instead of rebuilding it.
+
+e.g.
+    index = grid_index(ds)
+    cells, distance_km = index.query([51.5, 23.8], [-0.1, 90.4]) # cells: {'lat': [i, ...], 'lon': [j, ...]}
+    ds.isel({dim: xr.DataArray(positions, dims='location') for dim, positions in cells.items()})
+"""
+
+GRID_INDEX_DIR = os.environ.get("CLIMATE_GRID_INDEX_DIR", os.path.join(os.path.expanduser("~"), ".cache", "climate", "grid_index"))
+EARTH_RADIUS_KM = 6371.0
+
+# smaller grids (e.g. point-extracted data) are cheaper to build than to load, they are only kept in memory
+PERSIST_MIN_CELLS = 10000
+
+LATITUDE_NAMES = ['lat', 'latitude', 'nav_lat']
+LONGITUDE_NAMES = ['lon', 'longitude', 'nav_lon']
+
+_indexes = {}
+
+
+def lat_lon_names(ds):
+    '''
+    names of the latitude and longitude coordinates of a dataset (by standard_name, else by the usual names)
+    '''
+    names = {}
+    for axis, candidates in [('latitude', LATITUDE_NAMES), ('longitude', LONGITUDE_NAMES)]:
+        by_standard_name = [name for name, coord in ds.coords.items() if coord.attrs.get('standard_name') == axis]
+        by_name = [name for name in candidates if name in ds.coords]
+        found = by_standard_name + by_name
+        assert found, "No {} coordinate in dataset (coordinates: {})".format(axis, list(ds.coords))
+        names[axis] = found[0]
+    return names['latitude'], names['longitude']
+
+def unit_vectors(lat, lon):
+    '''
+    (n, 3) unit-sphere positions of latitudes, longitudes in degrees
+    '''
+    lat, lon = np.radians(np.asarray(lat, dtype=float)), np.radians(np.asarray(lon, dtype=float))
+    return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1)
+
+def chord_to_km(chord):
+    '''
+    great-circle distance of a straight-line (chord) distance between unit-sphere points
+    '''
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.clip(np.asarray(chord) / 2, 0, 1))
+
+def grid_hash(lat, lon):
+    h = hashlib.sha1()
+    for coord in [lat, lon]:
+        h.update(str((coord.dims, coord.shape, str(coord.dtype))).encode())
+        h.update(np.ascontiguousarray(coord.values).tobytes())
+    return h.hexdigest()
+
+
+class GridIndex:
+    def __init__(self, lat, lon):
+        '''
+        lat, lon: DataArrays of the grid's coordinates, 1-d (regular grid, separate dims) or 2-d (curvilinear, same dims)
+        '''
+        if lat.ndim == 1 and lon.ndim == 1:
+            self.dims = (lat.dims[0], lon.dims[0])
+            grid_lat, grid_lon = np.meshgrid(lat.values, lon.values, indexing='ij')
+        else:
+            assert lat.dims == lon.dims, "Curvilinear latitude and longitude must share their dimensions"
+            self.dims = lat.dims
+            grid_lat, grid_lon = lat.values, lon.values
+        self.shape = grid_lat.shape
+        self.lat = grid_lat.ravel()
+        self.lon = grid_lon.ravel()
+        self.tree = cKDTree(unit_vectors(self.lat, self.lon))
+
+    def query(self, lat, lon):
+        '''
+        nearest grid cell of each point (lat, lon in degrees, any longitude convention)
+        returns {dim: positions} and the great-circle distances in km
+        '''
+        chord, flat = self.tree.query(unit_vectors(np.atleast_1d(lat), np.atleast_1d(lon)))
+        positions = np.unravel_index(flat, self.shape)
+        return dict(zip(self.dims, positions)), chord_to_km(chord)
+
+    def cell_coords(self, cells):
+        '''
+        (lat, lon) arrays of the cells returned by query
+        '''
+        flat = np.ravel_multi_index(tuple(cells[dim] for dim in self.dims), self.shape)
+        return self.lat[flat], self.lon[flat]
+
+
+def grid_index(ds):
+    '''
+    GridIndex of a dataset's grid, from memory, from GRID_INDEX_DIR or built (and saved) if new
+    '''
+    lat_name, lon_name = lat_lon_names(ds)
+    lat, lon = ds[lat_name], ds[lon_name]
+    key = grid_hash(lat, lon)
+    if key in _indexes:
+        return _indexes[key]
+
+    path = os.path.join(GRID_INDEX_DIR, key + ".pkl")
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            index = pickle.load(f)
+    else:
+        index = GridIndex(lat.load(), lon.load())
+        _indexes[key] = index
+        if index.lat.size < PERSIST_MIN_CELLS:
+            return index
+        print("Built grid index for {} x {} grid {}".format(lat.shape, lon.shape, key))
+        os.makedirs(GRID_INDEX_DIR, exist_ok=True)
+        tmp_path = "{}.tmp-{}".format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    _indexes[key] = index
+    return index
+
+def nearest_cells(ds, lat, lon, dim='location', labels=None):
+    '''
+    vectorized isel indexers of the grid cells nearest to the points lat, lon (along dim, labelled by labels)
+    and the great-circle distances (km) as a DataArray along dim
+    '''
+    cells, distance = grid_index(ds).query(lat, lon)
+    coords = {dim: labels} if labels is not None else {}
+    indexers = {name: xr.DataArray(positions, dims=dim, coords=coords) for name, positions in cells.items()}
+    return indexers, xr.DataArray(distance, dims=dim, coords=coords)
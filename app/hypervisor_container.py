@@ -1,11 +1,13 @@
-from data import Data, DataLocationType, DataType
-from climate_tasks import apply_bias_correction, select_location_and_quantiles, calculate_cost, process_data
+from data import Data, DataLocationType, DataType, prefetch
+from utils import get_coords, TASK_CHUNK_LAYOUT
+from uploads import UploadQueue
+from task_cache import TaskCache, TASK_PARAMETERS
+from climate_tasks import TASKS
+from telemetry import stage, debug, describe, nbytes
 import argparse
 import json
 import sys
-import boto3
-from datetime import datetime
-import pandas as pd
+import weakref
 
 # TEST_DATA_S3_URI = "s3://climate-ensembling/test_data.csv"
 TEST_DATA_KEY = "tst/EC-Earth3/"
@@ -47,6 +49,12 @@ class ContainerHypervisor():
         assert False, "Please use a subclass the implements this method."
 
 class ClimateHypervisor(ContainerHypervisor):
+    def __init__(self):
+        super().__init__()
+        # optional content-addressed cache of ProcessData / SelectLocation / BiasCorrection outputs
+        self.task_cache = TaskCache.from_environment()
+        # outputs are uploaded in the background while the next task runs
+        self.uploads = UploadQueue()
 
     def parse_args(self, verbose=True):
 
@@ -67,29 +75,56 @@ class ClimateHypervisor(ContainerHypervisor):
         s3_bucket = components[0]
         return s3_key, s3_bucket
 
-    def _parse_data(self, key, location_path): 
+    def _parse_data(self, key, location_path, coords=None, location_type=DataLocationType.S3, variables=None, layout=None): 
         if isinstance(location_path, type("")) and location_path.startswith("s3://"): # TODO Change to "if self.is_input_data(location_path)"
             s3_key, s3_bucket = self.parse_s3_uri(location_path)
             print("Parsing data for key: {} location_path: {}, coming from s3 key {} and bucket {}.".format(key, location_path, s3_key, s3_bucket))
             if key not in self.data:
-                self.data[key] = {}
-            dtype = DataType.CSV if '.csv' in location_path else DataType.MDF
-            print("Retrieving for bucket {} and key {}".format(s3_bucket, s3_key))
-            self.data[key][location_path] = (Data(dtype, DataLocationType.S3, s3_key=s3_key, s3_bucket_name=s3_bucket))
+                # handles are only kept while a task or pipeline node still uses them
+                self.data[key] = weakref.WeakValueDictionary()
+            if '.csv' in location_path:
+                dtype = DataType.CSV
+            elif '.zarr' in location_path:
+                dtype = DataType.ZARR
+            else:
+                dtype = DataType.MDF
+            data = self.data[key].get(location_path)
+            if data is None or (data.data_location, data.coords, data.variables, data.layout) != (location_type, coords, variables, layout):
+                data = Data(dtype, location_type, s3_key=s3_key, s3_bucket_name=s3_bucket, coords=coords, variables=variables, layout=layout)
+                self.data[key][location_path] = data
         else:
             return location_path
-        return self.data[key][location_path]
+        return data
 
     def load_data(self, inputs, parameters):
         """
         Returns the parameters ditionary, combined with the inputs, having loaded any parameters in either that were from S3 and replaced them with a Data object.
+        Data objects are lazy: only the inputs a task reads (Data.df) are fetched.
         
         e.g
         {'base_model' : Data(s3_key='s3://.....', ...)}
         """
 
+        with stage("load_data") as record:
+            loaded_parameters = self._load_data(inputs, parameters)
+            record["input_bytes"] = nbytes(loaded_parameters)
+        return loaded_parameters
+
+    def _load_data(self, inputs, parameters):
         loaded_parameters = {}
 
+        # point-extraction pipeline: resolve the location first and only read that grid cell
+        coords = None
+        if parameters.get('point_extraction', False) and isinstance(parameters.get('location'), str):
+            coords = get_coords(parameters['location'])
+            print("Point extraction for location {} at {}".format(parameters['location'], coords))
+
+        # lazy remote mode: open S3 objects in place instead of downloading them
+        location_type = DataLocationType.S3_LAZY if parameters.get('lazy_remote', False) else DataLocationType.S3
+        variables = parameters.get('variables')
+        # chunk gridded data for the way the task reads it (time series / whole grids)
+        layout = parameters.get('chunk_layout', TASK_CHUNK_LAYOUT.get(getattr(self, 'args', {}).get('service_name')))
+
         for key, location_path in {**inputs, **parameters}.items():
             if key in parameters and key in inputs:
                 print("************** WARNING ************* inputs and parameters share a key ({}), this will cause issues, please rename one of them to a unique name.".format(key))
@@ -98,9 +133,9 @@ class ClimateHypervisor(ContainerHypervisor):
             if isinstance(location_path, list):
                 loaded = []
                 for loc in location_path:
-                    loaded.append(self._parse_data(key, loc))
+                    loaded.append(self._parse_data(key, loc, coords, location_type, variables, layout))
             else:
-                loaded = self._parse_data(key, location_path)
+                loaded = self._parse_data(key, location_path, coords, location_type, variables, layout)
             loaded_parameters[key] = loaded
 
         return loaded_parameters
@@ -122,53 +157,43 @@ class ClimateHypervisor(ContainerHypervisor):
 
         """
         print("Task: {}".format(task))
-        print("Parameters: {}".format(loaded_parameters))
-        outputs = None
-        if task == "SelectLocation":
-            outputs = select_location_and_quantiles(loaded_parameters)
-        
-        elif task == "BiasCorrection":
-            outputs =  apply_bias_correction(loaded_parameters)
+        debug("Parameters: {}", loaded_parameters)
 
-        elif task == "CalculateCosts":
-            outputs =  calculate_cost(loaded_parameters)
-
-        elif task == "ProcessData":
-            outputs = process_data(loaded_parameters)
-        elif task == "AggregateModels":
-            pass
-            # outputs = aggregate_models(loaded_parameters)
-        else:
-            assert False, "No valid task chosen!"
-        
+        with stage("run_task", task=task) as record:
+            outputs = self._cached_run_task(task, loaded_parameters)
+            record["input_bytes"] = nbytes(loaded_parameters) # after the task, inputs are loaded on use
+            record["output_bytes"] = nbytes(outputs)
         return outputs
 
+    def _cached_run_task(self, task, loaded_parameters):
+        if self.task_cache is not None and task in TASK_PARAMETERS:
+            key = self.task_cache.key(task, loaded_parameters)
+            outputs = self.task_cache.get(task, key)
+            if outputs is None:
+                # inputs are only fetched once the task has to run
+                prefetch([loaded_parameters.get(name) for name in TASK_PARAMETERS[task]])
+                outputs = self._run_task(task, loaded_parameters)
+                self.task_cache.put(task, key, outputs)
+            return outputs
+
+        return self._run_task(task, loaded_parameters)
+
+    def _run_task(self, task, loaded_parameters):
+        assert task in TASKS, "No valid task chosen!"
+        return TASKS[task](loaded_parameters)
+
     def upload_outputs(self, outputs, bucket_name='climate-ensembling'):
         """
         Assumes outputs is a list of DataFrames [df, df, ...]
+        Uploads run in the background, call flush_uploads() before the run ends.
         """
-        s3 = boto3.resource("s3")
-        print("Upload these outputs! Outputs: {}---".format(outputs))
-        # datetime object containing current date and time
-        now = datetime.now()
-        
-        print("now =", now)
-        dt_string = now.strftime("%d:%m:%Y:%H:%M")
-        # dd/mm/YY H:M:S
+        debug("Upload these outputs! Outputs: {}---", outputs)
         for location, output in outputs.values():
-                print("Output: {} Location: {}".format(output, location))
-                if isinstance(output, pd.DataFrame):
-                    filename=dt_string+'.csv'
-                    print("Output: {} {}".format(outputs, type(output)))
-                    output.to_csv(filename)
-                else:#is MFD type then
-                    filename=dt_string+'.nc'
-                    output.to_netcdf(filename)
-
-                s3_key, bucket_name = self.parse_s3_uri(location)
-                s3_bucket = s3.Bucket(name=bucket_name)
-                obj_name = s3_key + filename
-                print("Uploading local file {} to bucket {} and location {}".format(filename, s3_bucket, obj_name))
-                s3_bucket.upload_file(filename, obj_name)
-
-        print ("\n\nFinished uploading data!\n\n")
+                print("Output: {} Location: {}".format(describe(output), location))
+                self.uploads.submit(location, output)
+
+    def flush_uploads(self):
+        """
+        Blocks until all queued outputs are uploaded.
+        """
+        return self.uploads.flush()
@@ -1,8 +1,17 @@
 #!/usr/bin/env python
 
+import os
+import re
+import numpy as np
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from hypervisor_container import ClimateHypervisor
 from data import Data, DataLocationType, DataType
+from climate_tasks import location_costs
+from pipeline import Pipeline, Ref
+from telemetry import start_run, debug, describe
+from cluster import dask_cluster
+from dataset_cache import task_leases
 
 """
 Interface Design
@@ -14,6 +23,228 @@ Outputs are not lists but single layer dictionaries of strings, if there is more
 
 """
 
+def output_prefix(location, key, name):
+    """
+    Output prefix for e.g. a city or model: replaces the '<key>-<name>/' part of the prefix, or appends one.
+    """
+    part = '{}-{}/'.format(key, name.replace(' ', '_'))
+    pattern = r'{}-[^/]*/'.format(key)
+    if re.search(pattern, location):
+        return re.sub(pattern, part, location)
+    return location + part
+
+def model_name(model_location):
+    """
+    Model name from its location, e.g. 's3://climate-ensembling/models/EC-Earth3/' -> 'EC-Earth3'.
+    """
+    return model_location.rstrip('/').split('/')[-1]
+
+def cost_records(model_location, location_name, quantiles, window_outputs):
+    """
+    Rows of the consolidated Parquet cost table, one per threshold and window, the reordering
+    is stored as the int32 permutation of the bias-corrected model series.
+    """
+    records = []
+    for i, quantile in enumerate(quantiles):
+        for window, costs, reordered in window_outputs:
+            records.append({"model": model_name(model_location), "location": location_name, "threshold": float(quantile),
+                            "window": window, "cost": float(costs[i]), "reordered": np.asarray(reordered, dtype=np.int32)})
+    return records
+
+def upload_window_outputs(hv, output_locations, model_location, location_name, quantiles, window_outputs, cost_table=None):
+    """
+    Build one outputs DataFrame per quantile from [(window, costs, reordered), ...] and upload it.
+    With a cost_table (list, output_format 'parquet') the rows are added to it instead, see upload_cost_table.
+    """
+    if cost_table is not None:
+        cost_table.extend(cost_records(model_location, location_name, quantiles, window_outputs))
+        return
+
+    for i, quantile in enumerate(quantiles):
+        print("\nQuantile: {}".format(quantile))
+        final_outputs = []
+        for window, costs, reordered in window_outputs:
+            final_outputs.append((model_location, location_name, quantile, window, costs[i], np.asarray(reordered).tolist()))
+        final_outputs_df = pd.DataFrame(final_outputs, columns=["model_name", "location", 'threshold', 'window', 'cost', 'reordered'])
+        debug("\n\nFinal_outputs_df: {}", final_outputs_df)
+
+        # Save / upload
+        combined_output_locations = {}
+        for k in output_locations.keys():
+            quantile_location = output_locations[k]+'threshold-{}/'.format(quantile)
+            combined_output_locations[k] = (quantile_location, final_outputs_df)
+        debug("combined_output_locations: {}", combined_output_locations)
+
+        hv.upload_outputs(combined_output_locations)
+
+def upload_cost_table(hv, output_locations, cost_table):
+    """
+    Upload all cost rows of the run as one Parquet dataset '<output location>costs.parquet/',
+    partitioned by model/location/threshold.
+    """
+    cost_table_df = pd.DataFrame(cost_table, columns=["model", "location", "threshold", "window", "cost", "reordered"])
+    debug("\n\nCost table: {}", cost_table_df)
+    hv.upload_outputs({k: (v + 'costs.parquet/', cost_table_df) for k, v in output_locations.items()})
+
+def select_reference(hv, loaded_parameters):
+    """
+    SelectLocation on the reference, returns the reference series as Data and its quantiles.
+    """
+    #og_model = loaded_parameters['model']
+    #loaded_parameters['model'] = loaded_parameters['reference']
+    #reference_output = hv.run_task("ProcessData", loaded_parameters)
+    #print("Direct output of ProcessData for reference: {} ".format(reference_output))
+    #loaded_parameters['reference'] = Data(DataType.MDF, DataLocationType.LOCAL, df=reference_output[0])
+    #loaded_parameters['model'] = og_model
+
+    debug("************************ Reference Processing Data ********************* \n {}", loaded_parameters)
+
+    og_model = loaded_parameters['model']
+    loaded_parameters['model'] = loaded_parameters['reference']
+    reference_output, quantiles = hv.run_task("SelectLocation", loaded_parameters)
+    print("Direct output of SelectLocation for reference: {} ".format(describe(reference_output)))
+    loaded_parameters['model'] = og_model
+    return Data(DataType.MDF, DataLocationType.LOCAL, df=reference_output), quantiles
+
+def add_model_costs(pipeline, model, reference, thresholds, windows):
+    """
+    Add the ProcessData -> SelectLocation -> BiasCorrection -> CalculateCosts (one node per window, on the
+    process pool) nodes for model against the selected reference series to pipeline.
+    model, reference, thresholds: values or Refs to other nodes.
+    """
+    pipeline.add("process", "ProcessData", {'model': model, 'reference': reference})
+    pipeline.add("location", "SelectLocation", {'model': Ref("process")})
+    pipeline.add("bias", "BiasCorrection", {'model': Ref("location"), 'reference': reference})
+    # reordering does not depend on the threshold: solve once per window, score every quantile
+    for window, node in zip(windows, window_nodes(windows)):
+        pipeline.add(node, "CalculateCostsThresholds",
+                     {'model': Ref("bias", 0), 'reference': Ref("bias", 1), 'thresholds': thresholds, 'window': window},
+                     executor='process')
+
+def collect_window_outputs(results, windows):
+    """
+    [(window, costs, reordered), ...] from the pipeline results
+    """
+    return [(window, *results[node]) for window, node in zip(windows, window_nodes(windows))]
+
+def window_nodes(windows):
+    return ["costs-{}".format(window) for window in windows]
+
+def model_costs(hv, loaded_parameters, reference, quantiles):
+    """
+    ProcessData -> SelectLocation -> BiasCorrection -> CalculateCosts for every window and threshold
+    of loaded_parameters['model'] against the selected reference series, returns [(window, costs, reordered), ...]
+    """
+    debug("************************ Model Processing Data ********************* \n {}", loaded_parameters)
+
+    windows = hv.args['parameters']['window']
+    pipeline = Pipeline(hv, hv.args['parameters'].get('processes'))
+    add_model_costs(pipeline, loaded_parameters['model'], reference, list(quantiles), windows)
+    results = pipeline.run(loaded_parameters, keep=window_nodes(windows))
+    return collect_window_outputs(results, windows)
+
+def calculate_costs_all(hv, inputs, output_locations, cost_table=None):
+    """
+    CalculateCostsAll for a single location as a pipeline: the reference and model are loaded concurrently,
+    SelectLocation (reference) -> ProcessData -> SelectLocation -> BiasCorrection -> CalculateCosts for every
+    window and threshold, the windows run in parallel.
+    """
+    parameters = hv.args['parameters']
+    model_location = parameters['model']
+    location_name = parameters['location']
+    windows = parameters['window']
+
+    # Data handles are lazy: a dataset is only fetched by the first task reading it, after that task has missed
+    # the task cache (see ClimateHypervisor._cached_run_task), so a warm cache skips the downloads
+    def load_reference(_):
+        return [hv.load_data(inputs, {**parameters, 'model': None})['reference']]
+
+    def load_model(_):
+        return [hv.load_data({}, {**parameters, 'reference': None})['model']]
+
+    pipeline = Pipeline(hv, parameters.get('processes'))
+    pipeline.add("load_reference", load_reference)
+    pipeline.add("load_model", load_model)
+    pipeline.add("reference_location", "SelectLocation", {'model': Ref("load_reference")})
+    add_model_costs(pipeline, Ref("load_model"), Ref("reference_location", 0), Ref("reference_location", 1, data=False), windows)
+
+    # the loaded datasets and intermediate series are freed as soon as the nodes using them have finished
+    results = pipeline.run({k: v for k, v in parameters.items() if k not in ['model', 'reference']},
+                           keep=["reference_location"] + window_nodes(windows))
+    quantiles = results["reference_location"][1]
+    upload_window_outputs(hv, output_locations, model_location, location_name, quantiles, collect_window_outputs(results, windows), cost_table)
+
+def calculate_costs_ensemble(hv, inputs, output_locations, cost_table=None):
+    """
+    CalculateCostsAll for a list of models: the reference is loaded and selected once and kept in memory,
+    the models are streamed through the pipeline, loading the next model while the current one is computed.
+    """
+    parameters = hv.args['parameters']
+    model_locations = parameters['model']
+    location_name = parameters['location']
+
+    loaded_parameters = hv.load_data(inputs, {**parameters, 'model': None})
+    reference, quantiles = select_reference(hv, loaded_parameters)
+
+    def load_model(model_location):
+        return hv.load_data({}, {**parameters, 'model': model_location, 'reference': None})['model'].load()
+
+    with ThreadPoolExecutor(max_workers=1) as loader:
+        next_model = loader.submit(load_model, model_locations[0])
+        for i, model_location in enumerate(model_locations):
+            print("\n************************ Ensemble model {}/{}: {} *********************".format(i + 1, len(model_locations), model_location))
+            loaded_parameters['model'] = next_model.result()
+            if i + 1 < len(model_locations):
+                next_model = loader.submit(load_model, model_locations[i + 1])
+
+            window_outputs = model_costs(hv, dict(loaded_parameters), reference, quantiles)
+            model_output_locations = {k: output_prefix(v, 'model', model_name(model_location)) for k, v in output_locations.items()}
+            upload_window_outputs(hv, model_output_locations, model_location, location_name, quantiles, window_outputs, cost_table)
+
+            # release the model before the next one is loaded on top of it
+            loaded_parameters['model'].release()
+            loaded_parameters['model'] = None
+
+def calculate_costs_batch(hv, loaded_parameters, output_locations, cost_table=None):
+    """
+    CalculateCostsAll for a list of locations: the datasets are loaded once, all grid points are
+    extracted together and the per-location bias-correction/reorder/cost stages run on a process pool.
+    """
+    parameters = hv.args['parameters']
+    locations = parameters['location']
+    model_location = parameters['model']
+
+    print("************************ Reference Selecting {} Locations ********************* ".format(len(locations)))
+    og_model = loaded_parameters['model']
+    loaded_parameters['model'] = loaded_parameters['reference']
+    reference_output, quantiles = hv.run_task("SelectLocations", loaded_parameters)
+    loaded_parameters['reference'] = Data(DataType.MDF, DataLocationType.LOCAL, df=reference_output)
+    loaded_parameters['model'] = og_model
+
+    print("************************ Model Selecting {} Locations ********************* ".format(len(locations)))
+    sl_output, _ = hv.run_task("SelectLocations", loaded_parameters)
+    loaded_parameters['model'] = Data(DataType.MDF, DataLocationType.LOCAL, df=sl_output)
+
+    pd_output = hv.run_task("ProcessData", loaded_parameters)
+    model_output = pd_output[0].load()
+
+    location_parameters = []
+    for location in locations:
+        location_parameter = {k: v for k, v in loaded_parameters.items() if k not in ['model', 'reference', 'location']}
+        location_parameter['location'] = location
+        location_parameter['windows'] = parameters['window']
+        location_parameter['thresholds'] = list(quantiles[location])
+        location_parameter['model'] = Data(DataType.MDF, DataLocationType.LOCAL, df=model_output.sel(location=location))
+        location_parameter['reference'] = Data(DataType.MDF, DataLocationType.LOCAL, df=reference_output.sel(location=location))
+        location_parameters.append(location_parameter)
+
+    with ProcessPoolExecutor(max_workers=parameters.get('processes', os.cpu_count())) as pool:
+        for location, window_outputs in zip(locations, pool.map(location_costs, location_parameters)):
+            print("\n************************ Outputs for location {} *********************".format(location))
+            city_output_locations = {k: output_prefix(v, 'location', location) for k, v in output_locations.items()}
+            upload_window_outputs(hv, city_output_locations, model_location, location, quantiles[location], window_outputs, cost_table)
+
+
 if __name__ == "__main__":
     print("******************************************\n Hello and welcome to the Climate Ensembling Dreamworld!\n******************************************")
 
@@ -25,81 +256,44 @@ if __name__ == "__main__":
     output_locations = hv.args['outputs']
     
     print("Running task with parameters {}".format(hv.args))
+    start_run(service_name) # one JSON metrics record is printed when the run exits
 
-    if service_name == "CalculateCostsAll": #Fast experiment, all tasks in one run mode
-        parameters = hv.args['parameters']
-        windows = parameters['window']
-        model_location = parameters['model']
-        location_name = parameters['location']
-        loaded_parameters = hv.load_data(inputs, parameters) # -> [Data]
-        
-        #og_model = loaded_parameters['model']
-        #loaded_parameters['model'] = loaded_parameters['reference']
-        #reference_output = hv.run_task("ProcessData", loaded_parameters)
-        #print("Direct output of ProcessData for reference: {} ".format(reference_output))
-        #loaded_parameters['reference'] = Data(DataType.MDF, DataLocationType.LOCAL, df=reference_output[0])
-        #loaded_parameters['model'] = og_model
-
-        print("************************ Reference Processing Data ********************* \n {}".format(loaded_parameters))
-
-        og_model = loaded_parameters['model']
-        loaded_parameters['model'] = loaded_parameters['reference']
-        reference_output, quantiles = hv.run_task("SelectLocation", loaded_parameters)
-        print("Direct output of SelectLocation for reference: {} ".format(reference_output))
-        loaded_parameters['reference'] = Data(DataType.MDF, DataLocationType.LOCAL, df=reference_output)
-        loaded_parameters['model'] = og_model
-
-        print("************************ Model Processing Data ********************* \n {}".format(loaded_parameters))
-
-        pd_output = hv.run_task("ProcessData", loaded_parameters)
-        print("Direct output of ProcessData: {} ".format(pd_output))
-        loaded_parameters['model'] = Data(DataType.MDF, DataLocationType.LOCAL, df=pd_output[0])
-        print("Parameters after ProcessData update: {}".format(loaded_parameters))
-
-        sl_output, _ = hv.run_task("SelectLocation", loaded_parameters)
-        print("Direct output of SelectLocation: {} {}".format(sl_output, quantiles))
-        loaded_parameters['model'] = Data(DataType.MDF, DataLocationType.LOCAL, df=sl_output)
-        print("Parameters after SelectLocation update: {}".format(loaded_parameters))
-
-        bc_output = hv.run_task("BiasCorrection", loaded_parameters)
-        print("Direct output of BiasCorrection: {} ".format(bc_output))
-        loaded_parameters['model'] = Data(DataType.MDF, DataLocationType.LOCAL, df=bc_output[0])
-        loaded_parameters['reference'] = Data(DataType.MDF, DataLocationType.LOCAL, df=bc_output[1])
-        print("Parameters after BiasCorrection update: {}".format(loaded_parameters))
-
-        for quantile in quantiles:
-            print("\nQuantile: {}".format(quantile))
-            loaded_parameters['threshold'] = quantile
-            final_outputs = []
-            for window in windows:
-                print("Window: {}".format(window))
-                loaded_parameters['window'] = window
-                cost, reordered = hv.run_task("CalculateCosts", loaded_parameters)
-                final_outputs.append((model_location, location_name, quantile, window, cost, reordered))
-            final_outputs_df = pd.DataFrame(final_outputs, columns=["model_name", "location", 'threshold', 'window', 'cost', 'reordered'])
-            print("\n\nFinal_outputs_df: {}".format(final_outputs_df))
-            
-            # Save / upload
-            combined_output_locations = {}
-            for i, (k) in enumerate(output_locations.keys()):
-                quantile_location = output_locations[k]+'threshold-{}/'.format(quantile)
-                combined_output_locations[k] = (quantile_location, final_outputs_df)
-            print("combined_output_locations: {}".format(combined_output_locations))
+    # optional local dask cluster sized to the container, for the gridded computations
+    run_parameters = hv.args['parameters'] if service_name == "CalculateCostsAll" else hv.args['parameters'][service_name]
+    # cached datasets used by the run can be evicted by other tasks once it ends
+    with dask_cluster(run_parameters), task_leases():
+        if service_name == "CalculateCostsAll": #Fast experiment, all tasks in one run mode
+            parameters = hv.args['parameters']
+            # 'csv' (one file per threshold and location) or 'parquet' (one partitioned table per run)
+            cost_table = [] if parameters.get('output_format', 'csv') == 'parquet' else None
 
-            hv.upload_outputs(combined_output_locations)            
+            if isinstance(parameters['model'], list): # Ensemble mode, many models sharing one reference
+                calculate_costs_ensemble(hv, inputs, output_locations, cost_table)
+            elif isinstance(parameters['location'], list): # Batch mode, many locations in one run
+                loaded_parameters = hv.load_data(inputs, parameters) # -> [Data]
+                calculate_costs_batch(hv, loaded_parameters, output_locations, cost_table)
+            else:
+                calculate_costs_all(hv, inputs, output_locations, cost_table)
 
-    else: # Normal mode
-        parameters = hv.args['parameters'][service_name]
-        loaded_parameters = hv.load_data(inputs, parameters) # -> [Data]
-        print("************************ Data ********************* \n {}".format(loaded_parameters))
+            if cost_table is not None:
+                upload_cost_table(hv, output_locations, cost_table)
 
-        outputs = hv.run_task(service_name, loaded_parameters)
-        print("Returned outputs from run_task: {}".format(outputs))
-        combined_output_locations = {}
-        for i, (k) in enumerate(output_locations.keys()):
-            combined_output_locations[k] = (output_locations[k], outputs[i])
-        print("combined_output_locations: {}".format(combined_output_locations))
+            hv.flush_uploads() # uploads run in the background, wait for them before exiting
+            print("\n\nWe're done!!!!!\n\n\n")
 
-        hv.upload_outputs(combined_output_locations)
-        print("\n\nWe're done!!!!!\n\n\n")
+        else: # Normal mode
+            parameters = hv.args['parameters'][service_name]
+            loaded_parameters = hv.load_data(inputs, parameters) # -> [Data]
+            debug("************************ Data ********************* \n {}", loaded_parameters)
+
+            outputs = hv.run_task(service_name, loaded_parameters)
+            print("Returned outputs from run_task: {}".format(describe(outputs)))
+            combined_output_locations = {}
+            for i, (k) in enumerate(output_locations.keys()):
+                combined_output_locations[k] = (output_locations[k], outputs[i])
+            debug("combined_output_locations: {}", combined_output_locations)
+
+            hv.upload_outputs(combined_output_locations)
+            hv.flush_uploads()
+            print("\n\nWe're done!!!!!\n\n\n")
  
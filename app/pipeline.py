@@ -0,0 +1,217 @@
+import os
+import multiprocessing
+import numpy as np
+import pandas as pd
+import utils
+from multiprocessing import shared_memory
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from data import Data, DataLocationType, DataType
+from climate_tasks import TASKS
+from telemetry import stage, add_record
+
+"""
+Small declarative pipeline engine.
+
+A pipeline is a DAG of named nodes. Each node runs a registered task (see climate_tasks.TASKS) or a callable
+on a parameters dictionary and returns a list of outputs. Node inputs are either literal values or Ref()s
+to outputs of other nodes, so the engine knows the dependencies and runs every node as soon as its inputs
+are ready: independent nodes run concurrently on a thread pool (through ClimateHypervisor.run_task, so
+the task cache applies), CPU-bound nodes marked executor='process' run on a process pool.
+
+Data inputs of process nodes are passed as numpy arrays in shared memory rather than pickled. Worker processes are
+started from a fork server, not forked from the running pipeline, so they never inherit a lock held by one of its
+threads (e.g. telemetry, uploads), and they share the cpus for their own chunked reorderings (utils.CHUNK_PROCESSES).
+
+e.g.
+    pipeline = Pipeline(hv)
+    pipeline.add("select", "SelectLocation", {"model": reference})
+    pipeline.add("costs", "CalculateCostsThresholds", {"model": ..., "thresholds": Ref("select", 1, data=False)}, executor='process')
+    results = pipeline.run(parameters) # {node name: [outputs]}
+"""
+
+
+class Ref:
+    '''
+    reference to output index of node, passed on as a LOCAL Data object (data=True) or as the raw value
+    '''
+    def __init__(self, node, index=0, data=True):
+        self.node = node
+        self.index = index
+        self.data = data
+
+    def resolve(self, results):
+        value = results[self.node][self.index]
+        if self.data and not isinstance(value, Data):
+            return Data(DataType.MDF, DataLocationType.LOCAL, df=value)
+        return value
+
+
+class Node:
+    def __init__(self, name, task, inputs, executor):
+        self.name = name
+        self.task = task
+        self.inputs = inputs
+        self.executor = executor
+
+    def dependencies(self):
+        return {value.node for value in self.inputs.values() if isinstance(value, Ref)}
+
+
+##################### shared memory #####################
+
+def share_array(array):
+    '''
+    copy array into a new shared memory block, returns (block, descriptor for attach_array)
+    '''
+    array = np.ascontiguousarray(array)
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+    return block, (block.name, array.shape, array.dtype.str)
+
+def attach_array(descriptor):
+    '''
+    returns (block, array view) of a shared array, the block must be closed after use
+    '''
+    name, shape, dtype = descriptor
+    block = shared_memory.SharedMemory(name=name)
+    return block, np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+
+class SharedSeries:
+    '''
+    placeholder for a 1-d Data input of a process node, held in shared memory
+    '''
+    def __init__(self, descriptor):
+        self.descriptor = descriptor
+
+def _run_process_task(task, parameters):
+    '''
+    process pool entry point: attach shared arrays as Data inputs and run the registered task
+    returns the outputs and the telemetry record of the task (stages of worker processes are not collected otherwise)
+    '''
+    blocks = []
+    attached = {}
+    for key, value in parameters.items():
+        if isinstance(value, SharedSeries):
+            block, array = attach_array(value.descriptor)
+            blocks.append(block)
+            value = Data(DataType.MDF, DataLocationType.LOCAL, df=pd.Series(array, copy=False))
+        attached[key] = value
+    try:
+        with stage("process_task", task=task) as record:
+            outputs = TASKS[task](attached)
+        # outputs must not keep views of the shared blocks
+        return [np.array(output) if isinstance(output, np.ndarray) else output for output in outputs], record
+    finally:
+        for block in blocks:
+            block.close()
+
+
+def _init_process_worker(chunk_processes):
+    utils.CHUNK_PROCESSES = chunk_processes
+
+def process_pool(max_workers=None):
+    '''
+    pool of the process nodes: fork-server workers, the cpus divided between them for nested chunked reorderings
+    '''
+    max_workers = max_workers or os.cpu_count() or 1
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("forkserver"),
+                               initializer=_init_process_worker, initargs=(max(1, (os.cpu_count() or 1) // max_workers),))
+
+
+##################### pipeline #####################
+
+class Pipeline:
+    def __init__(self, hv, max_workers=None):
+        self.hv = hv
+        self.max_workers = max_workers
+        self.nodes = {}
+
+    def add(self, name, task, inputs=None, executor='thread'):
+        '''
+        add a node running task (registered task name or callable: parameters -> [outputs])
+        with the run parameters updated by inputs (literal values or Refs to other nodes)
+        executor 'thread' or 'process' (registered tasks with 1-d Data inputs only)
+        '''
+        assert name not in self.nodes, "Duplicate pipeline node {}".format(name)
+        assert executor == 'thread' or isinstance(task, str), "Process nodes must run a registered task"
+        self.nodes[name] = Node(name, task, inputs or {}, executor)
+        return name
+
+    def _parameters(self, node, parameters, results):
+        node_parameters = dict(parameters)
+        for key, value in node.inputs.items():
+            node_parameters[key] = value.resolve(results) if isinstance(value, Ref) else value
+        return node_parameters
+
+    def _submit(self, node, parameters, threads, processes, blocks):
+        if node.executor == 'process':
+            shared = {}
+            for key, value in parameters.items():
+                if isinstance(value, Data) and value.df is not None and np.ndim(value.df) == 1:
+                    block, descriptor = share_array(np.asarray(value.df.values))
+                    blocks.setdefault(node.name, []).append(block)
+                    value = SharedSeries(descriptor)
+                shared[key] = value
+            return processes.submit(_run_process_task, node.task, shared)
+
+        if isinstance(node.task, str):
+            return threads.submit(self.hv.run_task, node.task, parameters)
+        return threads.submit(node.task, parameters)
+
+    def _drop_unused(self, name, keep, dependents, results):
+        '''
+        drop the outputs no remaining node needs, after node name finished
+        '''
+        for dependency in self.nodes[name].dependencies() | {name}:
+            dependents[dependency].discard(name)
+            if not dependents[dependency] and dependency not in keep:
+                results.pop(dependency, None)
+
+    def run(self, parameters, keep=None):
+        '''
+        run all nodes, returns {node name: list of outputs}
+        keep: optional node names whose outputs are returned, the outputs of the other nodes are dropped
+        as soon as the nodes depending on them have finished (so e.g. loaded datasets are freed mid-run)
+        '''
+        for node in self.nodes.values():
+            missing = node.dependencies() - set(self.nodes)
+            assert not missing, "Node {} depends on unknown nodes {}".format(node.name, missing)
+
+        results = {}
+        finished = set()
+        dependents = {name: {node.name for node in self.nodes.values() if name in node.dependencies()} for name in self.nodes}
+        pending = dict(self.nodes)
+        running = {}
+        blocks = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as threads, process_pool(self.max_workers) as processes:
+            try:
+                while pending or running:
+                    for name, node in list(pending.items()):
+                        if node.dependencies() <= finished:
+                            print("Pipeline: starting {} ({})".format(name, node.task if isinstance(node.task, str) else node.executor))
+                            future = self._submit(node, self._parameters(node, parameters, results), threads, processes, blocks)
+                            running[future] = name
+                            del pending[name]
+                    assert running, "Pipeline has a dependency cycle between {}".format(list(pending))
+
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        name = running.pop(future)
+                        if self.nodes[name].executor == 'process':
+                            results[name], record = future.result()
+                            add_record(record)
+                        else:
+                            results[name] = future.result()
+                        finished.add(name)
+                        print("Pipeline: finished {}".format(name))
+                        if keep is not None:
+                            self._drop_unused(name, keep, dependents, results)
+                        for block in blocks.pop(name, []):
+                            block.close()
+                            block.unlink()
+            finally:
+                for node_blocks in blocks.values():
+                    for block in node_blocks:
+                        block.close()
+                        block.unlink()
+        return results
@@ -0,0 +1,165 @@
+import numpy as np
+import xarray as xr
+import dask
+import dask.array as da
+
+"""
+Mergeable streaming quantile sketches (KLL, Karnin, Lang & Liberty 2016, https://arxiv.org/abs/1603.05346).
+
+A sketch keeps a small weighted sample of the values it has seen: level h holds items of weight 2^h, and a level
+that exceeds its capacity is sorted and every other item (random offset) is promoted to the next level. Sketches
+of chunks, years, grid cells or whole runs are merged by concatenating their levels, so the quantiles of a region
+are computed in one streaming pass over the data, chunk by chunk, without loading or sorting it.
+
+Error bound: with k items per level the rank of a returned quantile is within rank_error(k) * n of q * n with
+99% probability, rank_error(k) = 2.296 / k^0.9723 (the single-quantile bound of the Apache DataSketches KLL sketch,
+k=200: 1.33%). The sketch holds about 3k items; min and max (q = 0 / 1) are exact, and while fewer values than the
+level-0 capacity have been added the sketch is exact.
+
+e.g.
+    sketch = sketch_array(ds.tas) # dask chunks sketched in parallel, then merged
+    sketch.quantile([0.1, 0.9, 0.99])
+    sketch.merge(KLLSketch.from_dataset(xr.open_dataset("previous_years_sketch.nc")))
+"""
+
+DEFAULT_K = 200
+MIN_LEVEL_CAPACITY = 8
+CAPACITY_DECAY = 2 / 3
+
+
+def rank_error(k):
+    '''
+    normalized rank error of a quantile returned by a sketch with parameter k (99% confidence)
+    '''
+    return 2.296 / k ** 0.9723
+
+
+class KLLSketch:
+    def __init__(self, k=DEFAULT_K, seed=0):
+        self.k = int(k)
+        self.levels = [np.empty(0)]
+        self.n = 0
+        self.min = np.inf
+        self.max = -np.inf
+        self.rng = np.random.default_rng(seed)
+
+    @property
+    def rank_error(self):
+        return rank_error(self.k)
+
+    def capacity(self, level):
+        '''
+        capacity of a level, decreasing geometrically from k at the top level
+        '''
+        depth = len(self.levels) - level - 1
+        return max(MIN_LEVEL_CAPACITY, int(np.ceil(self.k * CAPACITY_DECAY ** depth)))
+
+    def update(self, values):
+        '''
+        add values (any shape, nan ignored), returns the sketch
+        '''
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[~np.isnan(values)]
+        if values.size:
+            self.n += values.size
+            self.min = min(self.min, values.min())
+            self.max = max(self.max, values.max())
+            self.levels[0] = np.concatenate([self.levels[0], values])
+            self.compress()
+        return self
+
+    def merge(self, other):
+        '''
+        add the values summarised by another sketch, returns the sketch
+        '''
+        self.k = min(self.k, other.k)
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+        for level, items in enumerate(other.levels):
+            self.levels[level] = np.concatenate([self.levels[level], items])
+        self.n += other.n
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.compress()
+        return self
+
+    def compress(self):
+        '''
+        compact the lowest full level until the sketch fits its capacity
+        '''
+        while sum(len(items) for items in self.levels) > sum(self.capacity(level) for level in range(len(self.levels))):
+            level = next(level for level, items in enumerate(self.levels) if len(items) >= self.capacity(level))
+            if level + 1 == len(self.levels):
+                self.levels.append(np.empty(0))
+            items = np.sort(self.levels[level])
+            odd = len(items) % 2 # an odd item out stays on its level
+            promoted = items[odd:][self.rng.integers(2)::2]
+            self.levels[level] = items[:odd]
+            self.levels[level + 1] = np.concatenate([self.levels[level + 1], promoted])
+
+    def quantile(self, q):
+        '''
+        approximate quantiles (within rank_error, see above) of the values seen so far, q: float or list of floats
+        '''
+        q = np.asarray(q, dtype=float)
+        if self.n == 0:
+            return np.full(q.shape, np.nan)
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(level_items), 2.0**level) for level, level_items in enumerate(self.levels)])
+        order = np.argsort(items, kind='stable')
+        items, cumulative = items[order], np.cumsum(weights[order])
+        positions = np.clip(np.searchsorted(cumulative, q * cumulative[-1], side='left'), 0, len(items) - 1)
+        result = items[positions]
+        result = np.where(q <= 0, self.min, np.where(q >= 1, self.max, result))
+        return result if q.ndim else float(result)
+
+    ##################### serialisation #####################
+
+    def to_dataset(self):
+        '''
+        sketch as a small Dataset (e.g. to upload as NetCDF and merge with sketches of other runs)
+        '''
+        items = np.concatenate(self.levels)
+        level = np.concatenate([np.full(len(level_items), level, dtype='i1') for level, level_items in enumerate(self.levels)])
+        return xr.Dataset({"items": ("item", items), "level": ("item", level)},
+                          attrs={"sketch": "KLL", "k": self.k, "n": self.n, "min": self.min, "max": self.max})
+
+    @classmethod
+    def from_dataset(cls, ds):
+        sketch = cls(int(ds.attrs["k"]))
+        items, level = ds["items"].values, ds["level"].values
+        sketch.levels = [items[level == h] for h in range(int(level.max()) + 1 if len(level) else 1)]
+        sketch.n = int(ds.attrs["n"])
+        sketch.min, sketch.max = float(ds.attrs["min"]), float(ds.attrs["max"])
+        return sketch
+
+
+##################### building sketches #####################
+
+def block_sketch(block, k, seed):
+    return KLLSketch(k, seed).update(block)
+
+def merge_sketches(*sketches):
+    merged = sketches[0]
+    for sketch in sketches[1:]:
+        merged.merge(sketch)
+    return merged
+
+def sketch_array(data, k=DEFAULT_K):
+    '''
+    KLLSketch of all values of a DataArray / numpy / dask array,
+    for dask arrays one sketch per chunk is built in parallel and the sketches are merged pairwise
+    '''
+    data = getattr(data, 'data', data)
+    if not isinstance(data, da.Array):
+        return KLLSketch(k).update(data)
+    sketches = [dask.delayed(block_sketch)(block, k, seed) for seed, block in enumerate(data.to_delayed().ravel())]
+    while len(sketches) > 1:
+        sketches = [dask.delayed(merge_sketches)(*sketches[i:i + 2]) for i in range(0, len(sketches), 2)]
+    return sketches[0].compute()
+
+def sketch_quantiles(data, q, k=DEFAULT_K):
+    '''
+    approximate np.quantile(data, q) in one streaming pass, see KLLSketch
+    '''
+    return sketch_array(data, k).quantile(q)
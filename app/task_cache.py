@@ -0,0 +1,256 @@
+import os
+import json
+import time
+import shutil
+import pickle
+import hashlib
+import weakref
+import numpy as np
+import pandas as pd
+import xarray as xr
+from data import Data, DataLocationType
+from telemetry import count
+from clients import s3_client
+from utils import evict_lru
+
+"""
+Content-addressed cache for intermediate task outputs.
+
+Each cached task is keyed on a hash of the task name, the identity of its input data and the parameters
+the task actually uses, so changing e.g. the window list re-uses ProcessData / SelectLocation / BiasCorrection.
+Entries are stored in a local directory (NetCDF / Parquet / pickle per output), evicted least-recently-used
+above a size limit, and optionally mirrored to an S3 prefix.
+
+Configured from the environment:
+    CLIMATE_TASK_CACHE_DIR      local cache directory (cache is disabled if not set)
+    CLIMATE_TASK_CACHE_MAX_GB   size limit of the local cache (default 20)
+    CLIMATE_TASK_CACHE_S3       optional s3://bucket/prefix/ mirror
+"""
+
+# parameters each cached task depends on (besides its name)
+TASK_PARAMETERS = {
+    "ProcessData": ["model", "reference"],
+    "SelectLocation": ["model", "location", "start", "end", "quantiles", "quantile_method", "sketch_k"],
+    "SelectLocations": ["model", "location", "start", "end", "quantiles", "quantile_method", "sketch_k"],
+    "BiasCorrection": ["model", "reference", "past", "future", "bias_correction_method", "quantile_levels"],
+}
+
+MANIFEST = "manifest.json"
+
+
+def content_hash(obj):
+    '''
+    hash of the values, coordinates and names of an in-memory object
+    '''
+    h = hashlib.sha1()
+    if isinstance(obj, (xr.Dataset, xr.DataArray)):
+        ds = obj.to_dataset(name=obj.name or "__data__") if isinstance(obj, xr.DataArray) else obj
+        for name in sorted(ds.variables, key=str):
+            var = ds.variables[name]
+            h.update(str((name, var.dims, str(var.dtype))).encode())
+            h.update(np.ascontiguousarray(var.values).tobytes() if var.dtype != object else pickle.dumps(var.values))
+    elif isinstance(obj, (pd.DataFrame, pd.Series)):
+        h.update(pd.util.hash_pandas_object(obj, index=True).values.tobytes())
+    elif isinstance(obj, np.ndarray):
+        h.update(np.ascontiguousarray(obj).tobytes())
+    else:
+        h.update(pickle.dumps(obj))
+    return h.hexdigest()
+
+
+class TaskCache:
+    def __init__(self, directory, max_bytes=20 * 1024**3, s3_uri=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.s3_uri = s3_uri
+        self.s3 = s3_client() if s3_uri else None
+        # id(output) -> (weak reference to output, identity) for outputs produced or loaded by the cache,
+        # so they can be identified cheaply when passed on to the next task without keeping them alive
+        self._identities = {}
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    @classmethod
+    def from_environment(cls):
+        directory = os.environ.get("CLIMATE_TASK_CACHE_DIR")
+        if not directory:
+            return None
+        max_bytes = int(float(os.environ.get("CLIMATE_TASK_CACHE_MAX_GB", 20)) * 1024**3)
+        return cls(directory, max_bytes, os.environ.get("CLIMATE_TASK_CACHE_S3"))
+
+    ##################### keys #####################
+
+    def data_identity(self, data):
+        '''
+        identity of a Data object: its source for remote data, else its cached origin or content hash
+        '''
+        if data.data_location in [DataLocationType.S3, DataLocationType.S3_LAZY]:
+            return "s3://{}/{}|coords={}|variables={}".format(data.s3_bucket_name, data.s3_key, data.coords, data.variables)
+        return self.identity(data.df)
+
+    def identity(self, obj):
+        ref, identity = self._identities.get(id(obj), (None, None))
+        if ref is not None and ref() is obj:
+            return identity
+        return content_hash(obj)
+
+    def _value_identity(self, value):
+        if isinstance(value, Data):
+            return self.data_identity(value)
+        if isinstance(value, list):
+            return [self._value_identity(v) for v in value]
+        return value
+
+    def key(self, task, loaded_parameters):
+        inputs = {name: self._value_identity(loaded_parameters.get(name)) for name in TASK_PARAMETERS[task]}
+        description = json.dumps({"task": task, "inputs": inputs}, sort_keys=True, default=str)
+        return hashlib.sha1(description.encode()).hexdigest()
+
+    def remember(self, outputs, key):
+        for i, output in enumerate(outputs):
+            try:
+                ref = weakref.ref(output, self._forget(id(output)))
+            except TypeError: # e.g. lists, small enough to hash
+                continue
+            self._identities[id(output)] = (ref, "{}/{}".format(key, i))
+
+    def _forget(self, output_id):
+        identities = self._identities
+        def forget(ref):
+            # the id may already have been reused by a newer output
+            if identities.get(output_id, (None,))[0] is ref:
+                del identities[output_id]
+        return forget
+
+    ##################### storage #####################
+
+    def _entry(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, task, key):
+        entry = self._entry(key)
+        if not os.path.exists(os.path.join(entry, MANIFEST)) and not self._download_entry(key):
+            self.misses += 1
+            count("task_cache_misses", 1)
+            print("Task cache miss: {} {}".format(task, key))
+            return None
+
+        with open(os.path.join(entry, MANIFEST)) as f:
+            manifest = json.load(f)
+        outputs = [self._read_output(entry, item) for item in manifest["outputs"]]
+        os.utime(entry) # mark as recently used
+        self.hits += 1
+        count("task_cache_hits", 1)
+        print("Task cache hit: {} {}".format(task, key))
+        self.remember(outputs, key)
+        return outputs
+
+    def put(self, task, key, outputs):
+        entry = self._entry(key)
+        tmp_entry = "{}.tmp-{}".format(entry, os.getpid())
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+        os.makedirs(tmp_entry)
+
+        manifest = {"task": task, "created": time.time(), "outputs": [self._write_output(tmp_entry, i, output) for i, output in enumerate(outputs)]}
+        with open(os.path.join(tmp_entry, MANIFEST), 'w') as f:
+            json.dump(manifest, f)
+
+        self._publish(tmp_entry, entry)
+        print("Task cache stored: {} {}".format(task, key))
+
+        self.remember(outputs, key)
+        self._upload_entry(key)
+        self.evict()
+
+    def _publish(self, tmp_entry, entry):
+        '''
+        move a completely written entry into place, if a concurrent writer of the same key
+        got there first its (identical) entry is kept, as other processes may be reading it
+        '''
+        if os.path.exists(os.path.join(entry, MANIFEST)):
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+            return
+        shutil.rmtree(entry, ignore_errors=True) # incomplete leftover, never read
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+
+    def _write_output(self, entry, i, output):
+        if isinstance(output, xr.Dataset):
+            filename, kind = "output_{}.nc".format(i), "dataset"
+            output.to_netcdf(os.path.join(entry, filename))
+        elif isinstance(output, xr.DataArray):
+            filename, kind = "output_{}.nc".format(i), "dataarray"
+            output.to_netcdf(os.path.join(entry, filename))
+        elif isinstance(output, pd.DataFrame):
+            filename, kind = "output_{}.parquet".format(i), "dataframe"
+            output.to_parquet(os.path.join(entry, filename))
+        else:
+            filename, kind = "output_{}.pkl".format(i), "pickle"
+            with open(os.path.join(entry, filename), 'wb') as f:
+                pickle.dump(output, f)
+        return {"file": filename, "kind": kind}
+
+    def _read_output(self, entry, item):
+        path = os.path.join(entry, item["file"])
+        # opened lazily, cached outputs can be whole model grids
+        if item["kind"] == "dataset":
+            return xr.open_dataset(path, chunks={})
+        if item["kind"] == "dataarray":
+            return xr.open_dataarray(path, chunks={})
+        if item["kind"] == "dataframe":
+            return pd.read_parquet(path)
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    ##################### eviction #####################
+
+    def in_use(self):
+        '''
+        keys of the entries whose outputs this process still holds (opened lazily, so their files are still read)
+        '''
+        return {identity.split('/')[0] for ref, identity in list(self._identities.values()) if ref() is not None}
+
+    def evict(self):
+        '''
+        remove least-recently-used entries until the cache is below max_bytes, keeping the entries in use
+        '''
+        evict_lru(self.directory, self.max_bytes, keep=self.in_use())
+
+    ##################### s3 mirror #####################
+
+    def _s3_location(self, key):
+        components = self.s3_uri[5:].split('/', 1)
+        prefix = components[1] if len(components) > 1 else ''
+        return components[0], prefix.rstrip('/') + '/' + key + '/' if prefix else key + '/'
+
+    def _upload_entry(self, key):
+        if not self.s3:
+            return
+        bucket, prefix = self._s3_location(key)
+        entry = self._entry(key)
+        # manifest last, so a partially uploaded entry is never seen as complete
+        files = sorted(os.listdir(entry), key=lambda name: name == MANIFEST)
+        for name in files:
+            self.s3.upload_file(os.path.join(entry, name), bucket, prefix + name)
+
+    def _download_entry(self, key):
+        if not self.s3:
+            return False
+        bucket, prefix = self._s3_location(key)
+        response = self.s3.list_objects_v2(Bucket=bucket, Prefix=prefix)
+        names = [obj["Key"][len(prefix):] for obj in response.get("Contents", [])]
+        if MANIFEST not in names:
+            return False
+
+        entry = self._entry(key)
+        tmp_entry = "{}.tmp-{}".format(entry, os.getpid())
+        os.makedirs(tmp_entry, exist_ok=True)
+        for name in names:
+            self.s3.download_file(bucket, prefix + name, os.path.join(tmp_entry, name))
+        self._publish(tmp_entry, entry)
+        print("Task cache: fetched {} from {}".format(key, self.s3_uri))
+        return True
+
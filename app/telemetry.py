@@ -0,0 +1,184 @@
+import os
+import sys
+import json
+import time
+import uuid
+import atexit
+import resource
+import threading
+import functools
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+"""
+Per-stage performance telemetry.
+
+Stages (load_data, run_task, uploads and the heavy utils functions) are timed with
+
+    with stage("run_task", task=task) as record:
+        ...
+        record["output_bytes"] = nbytes(outputs)
+
+or the @timed decorator, recording wall time, CPU time, peak RSS and any bytes / array sizes added to the record.
+All records of a run are emitted as one JSON line (prefixed METRICS) at exit, and optionally written to a file.
+
+Configured from the environment:
+    CLIMATE_LOG_LEVEL       'info' (default) or 'debug': debug() dumps of whole parameters/datasets are only printed at 'debug'
+    CLIMATE_METRICS_PATH    optional file the JSON metrics record is also written to
+"""
+
+LOG_LEVEL = os.environ.get("CLIMATE_LOG_LEVEL", "info").lower()
+METRICS_PATH = os.environ.get("CLIMATE_METRICS_PATH")
+
+_lock = threading.Lock()
+_local = threading.local()
+_run = {"run_id": uuid.uuid4().hex, "service": None, "started": time.time(), "counters": {}, "stages": []}
+_registered = False
+
+
+def verbose():
+    return LOG_LEVEL == "debug"
+
+def debug(message, *args):
+    '''
+    print message.format(*args) at log level 'debug' only, args are not formatted otherwise
+    '''
+    if verbose():
+        print(message.format(*args))
+
+def peak_rss_mb():
+    # ru_maxrss is in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def nbytes(obj):
+    '''
+    in-memory size of (lists/dicts of) arrays, datasets and frames, without loading lazy data
+    '''
+    if isinstance(obj, (list, tuple)):
+        return sum(nbytes(o) for o in obj)
+    if isinstance(obj, dict):
+        return sum(nbytes(o) for o in obj.values())
+    if isinstance(obj, (xr.Dataset, xr.DataArray, np.ndarray)):
+        return int(obj.nbytes)
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(index=True, deep=False).sum())
+    if isinstance(obj, pd.Series):
+        return int(obj.memory_usage(index=True, deep=False))
+    if hasattr(obj, "loaded"): # Data, not loaded just to be measured
+        return nbytes(obj.df) if obj.loaded else 0
+    return 0
+
+def describe(obj):
+    '''
+    short description of an object for logs (type, dims/shape, size), the full repr at log level 'debug'
+    '''
+    if verbose():
+        return str(obj)
+    if isinstance(obj, (xr.Dataset, xr.DataArray)):
+        return "{} {} {:.1f} MB".format(type(obj).__name__, dict(obj.sizes), nbytes(obj) / 1e6)
+    if isinstance(obj, (np.ndarray, pd.DataFrame, pd.Series)):
+        return "{} {} {:.1f} MB".format(type(obj).__name__, obj.shape, nbytes(obj) / 1e6)
+    if isinstance(obj, (list, tuple)):
+        return "[{}]".format(", ".join(describe(o) for o in obj))
+    if isinstance(obj, dict):
+        return "{{{}}}".format(", ".join("{}: {}".format(k, describe(v)) for k, v in obj.items()))
+    return str(obj)
+
+def count(name, value):
+    '''
+    add value to a run-wide counter (e.g. bytes_downloaded) and to the current stage of this thread
+    '''
+    with _lock:
+        _run["counters"][name] = _run["counters"].get(name, 0) + value
+    stack = getattr(_local, "stack", [])
+    if stack:
+        stack[-1][name] = stack[-1].get(name, 0) + value
+
+@contextmanager
+def stage(name, **info):
+    '''
+    time a stage, yields its record (dict) so sizes can be added to it
+    '''
+    record = {"stage": name, **info}
+    stack = _local.__dict__.setdefault("stack", [])
+    if stack:
+        record["parent"] = stack[-1]["stage"]
+    stack.append(record)
+    rss_before = peak_rss_mb()
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield record
+    finally:
+        # cpu time is process-wide: concurrent stages overlap
+        record["wall_s"] = round(time.perf_counter() - wall, 4)
+        record["cpu_s"] = round(time.process_time() - cpu, 4)
+        record["peak_rss_mb"] = round(peak_rss_mb(), 1)
+        record["peak_rss_growth_mb"] = max(0., round(record["peak_rss_mb"] - rss_before, 1))
+        stack.pop()
+        add_record(record)
+
+def add_record(record):
+    with _lock:
+        _run["stages"].append(record)
+
+def timed(function):
+    '''
+    decorator recording a stage per call, named after the function
+    '''
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with stage(function.__name__):
+            return function(*args, **kwargs)
+    return wrapper
+
+def start_run(service_name):
+    '''
+    name the run and emit its metrics record at exit
+    '''
+    global _registered
+    _run["service"] = service_name
+    if not _registered:
+        atexit.register(emit)
+        _registered = True
+
+def summary():
+    '''
+    the run's metrics record: totals, counters and per-stage records, plus totals per stage name
+    '''
+    with _lock:
+        stages = list(_run["stages"])
+        counters = dict(_run["counters"])
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    totals = {}
+    for record in stages:
+        total = totals.setdefault(record["stage"], {"calls": 0, "wall_s": 0., "cpu_s": 0.})
+        total["calls"] += 1
+        total["wall_s"] = round(total["wall_s"] + record["wall_s"], 4)
+        total["cpu_s"] = round(total["cpu_s"] + record["cpu_s"], 4)
+    return {
+        "run_id": _run["run_id"],
+        "service": _run["service"],
+        "started": _run["started"],
+        "wall_s": round(time.time() - _run["started"], 4),
+        "cpu_s": round(time.process_time(), 4),
+        "children_cpu_s": round(children.ru_utime + children.ru_stime, 4),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "children_peak_rss_mb": round(children.ru_maxrss / 1024, 1),
+        **counters,
+        "stage_totals": totals,
+        "stages": stages,
+    }
+
+def emit():
+    '''
+    print the metrics record as one JSON line (and write it to CLIMATE_METRICS_PATH)
+    '''
+    record = json.dumps(summary(), default=str)
+    print("METRICS " + record)
+    sys.stdout.flush()
+    if METRICS_PATH:
+        with open(METRICS_PATH, 'w') as f:
+            f.write(record + "\n")
+    return record
@@ -0,0 +1,150 @@
+import io
+import os
+import uuid
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+import fsspec
+import pyarrow as pa
+import pyarrow.dataset as pa_dataset
+import pyarrow.parquet as pq
+from boto3.s3.transfer import TransferConfig
+from utils import write_zarr
+from clients import s3_client
+from telemetry import stage, count
+
+"""
+Background upload queue for task outputs.
+
+Outputs are serialised in memory and streamed to S3 (multipart above UPLOAD_MULTIPART_THRESHOLD) by a pool
+of threads sharing one client, so the next computation does not wait for the network.
+Locations ending in '.zarr' are written as Zarr stores, locations ending in '.parquet' as a Parquet dataset
+partitioned by PARTITION_COLUMNS (e.g. .../costs.parquet/model=EC-Earth3/location=Paris/threshold=24.4/part-....parquet).
+Partition values are only stored in the directory names, read the dataset with read_parquet_dataset (or pass
+partitioning() to pyarrow / pandas) so threshold reads back as a float instead of a string.
+Object names carry a microsecond timestamp and a random suffix, so outputs written at the same time never collide.
+flush() blocks until every queued upload has finished and re-raises the first upload error.
+
+Configured from the environment:
+    S3_UPLOAD_CONCURRENCY       number of outputs uploaded in parallel (default 8)
+"""
+
+S3_UPLOAD_CONCURRENCY = int(os.environ.get("S3_UPLOAD_CONCURRENCY", 8))
+UPLOAD_MULTIPART_THRESHOLD = 16 * 1024**2
+
+# columns a Parquet output table is partitioned by (those present in the table), with their types
+PARTITION_SCHEMA = pa.schema([("model", pa.string()), ("location", pa.string()), ("threshold", pa.float64())])
+PARTITION_COLUMNS = PARTITION_SCHEMA.names
+
+def partitioning(columns=PARTITION_COLUMNS):
+    '''
+    hive partitioning (column=value directories) of the Parquet outputs, with explicit column types
+    '''
+    return pa_dataset.partitioning(pa.schema([PARTITION_SCHEMA.field(column) for column in columns]), flavor="hive")
+
+def object_name(extension):
+    '''
+    unique output file name, e.g. '18:10:2026:14:03:07.123456-1a2b3c4d.csv'
+    '''
+    return "{}-{}{}".format(datetime.now().strftime("%d:%m:%Y:%H:%M:%S.%f"), uuid.uuid4().hex[:8], extension)
+
+def serialise_output(output):
+    '''
+    returns (in-memory file, extension): DataFrames as csv, datasets as NetCDF
+    '''
+    buffer = io.BytesIO()
+    if isinstance(output, pd.DataFrame):
+        buffer.write(output.to_csv().encode())
+        extension = '.csv'
+    else:
+        output.to_netcdf(buffer, engine="h5netcdf")
+        extension = '.nc'
+    buffer.seek(0)
+    return buffer, extension
+
+def write_parquet_dataset(df, location):
+    '''
+    write DataFrame to a (local or s3://) Parquet dataset partitioned by PARTITION_COLUMNS,
+    each call adds uniquely named part files, so several runs can write to the same dataset
+    '''
+    partition_columns = [column for column in PARTITION_COLUMNS if column in df.columns]
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    for column in partition_columns:
+        field = PARTITION_SCHEMA.field(column)
+        table = table.set_column(table.schema.get_field_index(column), field, table[column].cast(field.type))
+    fs, path = fsspec.core.url_to_fs(location)
+    print("Writing Parquet dataset {} ({} rows, partitioned by {})".format(location, len(df), partition_columns))
+    pq.write_to_dataset(table, path.rstrip('/'), partitioning=partitioning(partition_columns), filesystem=fs,
+                        basename_template="part-" + object_name("-{i}.parquet"))
+    return location
+
+def read_parquet_dataset(location, filters=None):
+    '''
+    DataFrame of a Parquet dataset written by write_parquet_dataset, with typed partition columns,
+    filters e.g. [("threshold", ">=", 24.0)]
+    '''
+    fs, path = fsspec.core.url_to_fs(location)
+    return pq.read_table(path.rstrip('/'), filesystem=fs, partitioning=partitioning(), filters=filters).to_pandas()
+
+
+class UploadQueue:
+    def __init__(self, concurrency=None):
+        concurrency = concurrency or S3_UPLOAD_CONCURRENCY
+        self.pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="upload")
+        # bounds the number of serialised outputs held in memory at once
+        self.slots = threading.BoundedSemaphore(2 * concurrency)
+        self.transfer_config = TransferConfig(multipart_threshold=UPLOAD_MULTIPART_THRESHOLD, max_concurrency=4)
+        self.futures = []
+        self.uploaded = []
+
+    def submit(self, location, output):
+        '''
+        queue output for upload to the s3:// location (a prefix, a '.zarr' store or a '.parquet' dataset)
+        '''
+        self.slots.acquire()
+        future = self.pool.submit(self._upload, location, output)
+        future.add_done_callback(lambda _: self.slots.release())
+        self.futures.append(future)
+        return future
+
+    def _upload(self, location, output):
+        with stage("upload", location=location):
+            return self._write(location, output)
+
+    def _write(self, location, output):
+        if location.rstrip('/').endswith('.zarr'):
+            # Zarr stores are written in place, chunk by chunk
+            write_zarr(output, location)
+            self.uploaded.append(location)
+            return location
+        if location.rstrip('/').endswith('.parquet'):
+            write_parquet_dataset(output, location)
+            self.uploaded.append(location)
+            return location
+
+        buffer, extension = serialise_output(output)
+        bucket_name, s3_key = location[5:].split('/', 1)
+        obj_name = s3_key + object_name(extension)
+        size = buffer.getbuffer().nbytes # upload_fileobj closes the buffer
+        print("Uploading {:.1f} MB to bucket {} and location {}".format(size / 1e6, bucket_name, obj_name))
+        s3_client().upload_fileobj(buffer, bucket_name, obj_name, Config=self.transfer_config)
+        count("bytes_uploaded", size)
+        self.uploaded.append("s3://{}/{}".format(bucket_name, obj_name))
+        return obj_name
+
+    def flush(self):
+        '''
+        wait for all queued uploads, re-raises the first failure, returns the uploaded locations
+        '''
+        futures, self.futures = self.futures, []
+        errors = [future.exception() for future in futures]
+        errors = [error for error in errors if error is not None]
+        if errors:
+            raise errors[0]
+        print("\n\nFinished uploading {} outputs!\n\n".format(len(futures)))
+        return list(self.uploaded)
+
+    def close(self):
+        self.flush()
+        self.pool.shutdown()
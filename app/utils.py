@@ -1,39 +1,202 @@
 import numpy as np
 import xarray as xr
+import fsspec
 import pandas as pd
 import scipy.interpolate as interp
 import calendar
 import os
+import hashlib
+import json
+import csv
+import time
+import shutil
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+from functools import partial
+from collections import OrderedDict
 from geopy.geocoders import Nominatim
+from geopy.extra.rate_limiter import RateLimiter
 from scipy.optimize import linear_sum_assignment
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import min_weight_full_bipartite_matching
 import cftime
+from telemetry import timed, count
+from grid_index import grid_index, nearest_cells, lat_lon_names
+from clients import s3_client
 
 ##################### import data #####################
 
+# local block cache for NetCDF files read lazily from S3 (see import_remote_dataset)
+REMOTE_CACHE_DIR = os.environ.get("CLIMATE_REMOTE_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "climate", "blocks"))
+
+# lat/lon chunk size for time-series access, e.g. in Zarr stores (time axis is never split)
+ZARR_SPACE_CHUNK = 8
+
+# target size of the dask chunks planned by plan_chunks
+CHUNK_TARGET_MB = int(os.environ.get("CLIMATE_CHUNK_MB", 128))
+
+# chunk layout for the data read by each task (see plan_chunks):
+# 'time' keeps whole time series in a chunk (location selection, calendar reindexing, bias correction, reordering),
+# 'space' keeps whole grids in a chunk (per time step operations over the field)
+TASK_CHUNK_LAYOUT = {
+    "ProcessData": "time",
+    "SelectLocation": "time",
+    "SelectLocations": "time",
+    "BiasCorrection": "time",
+    "CalculateCosts": "time",
+    "CalculateCostsThresholds": "time",
+    "CalculateCostsAll": "time",
+    "IngestZarr": "time",
+    "GriddedBiasCorrection": "time",
+    "RegionQuantiles": "space",
+}
+
 def get_local_directory():
     cwd = os.getcwd()
     print("CWD: {}".format(cwd))
     return cwd
 
-def import_dataset(directory, folder):
+@timed
+def import_dataset(directory, folder, coords=None, layout=None):
     '''
     read xarray multi-file dataset for CMIP5/CMIP6 global climate models
     folders are arranged per model as 'cmip5/<model_name>' or 'cmip6/<model_name>'
+    optionally only read the grid cell nearest to coords (lat, lon), see point_selector
+    optionally chunk for the access pattern layout ('time' or 'space'), see plan_chunks
     see: https://xarray.pydata.org/en/stable/generated/xarray.open_mfdataset.html
     '''
     #directory = '/Users/malavirdee/Documents/climate_data/'
     print("Import model: dir {} folder {}".format(directory, folder))
     path = os.path.join(directory+"/"+folder+"/*.nc")
-    return xr.open_mfdataset(path, engine="netcdf4")
+    preprocess = point_selector(coords) if coords is not None else None
+    ds = xr.open_mfdataset(path, engine="netcdf4", preprocess=preprocess)
+    return chunk_for_layout(ds, layout) if coords is None else ds
 
-def import_reference(directory, folder="reference/ERA5"):
+@timed
+def import_reference(directory, folder="reference/ERA5", coords=None, layout=None):
     '''
     read xarray reference dataset (i.e. ERA5 or ERA-Interim gridded observational reanalysis)
     see: https://www.ecmwf.int/en/forecasts/datasets/reanalysis-datasets/era5
     '''
     print("Import reference: dir {} folder {}".format(directory, folder))
     path = os.path.join(directory+"/"+folder+"/*.nc")
-    return xr.open_mfdataset(path, engine="netcdf4")
+    preprocess = point_selector(coords) if coords is not None else None
+    ds = xr.open_mfdataset(path, engine="netcdf4", preprocess=preprocess)
+    return chunk_for_layout(ds, layout) if coords is None else ds
+
+@timed
+def import_remote_dataset(url, coords=None, variables=None, layout=None):
+    '''
+    lazily open the *.nc files of a remote folder (e.g. s3://climate-ensembling/models/EC-Earth3/)
+    in place instead of downloading them: only the byte ranges of the variables, time range and
+    grid cell that are later computed are fetched, through a local block cache
+    optionally only keep variables (list) and the grid cell nearest to coords (lat, lon)
+    optionally chunk for the access pattern layout ('time' or 'space'), see plan_chunks
+    see: https://filesystem-spec.readthedocs.io/en/latest/features.html#caching-files-locally
+    '''
+    print("Import remote dataset (lazy): {}".format(url))
+    protocol = url.split("://")[0] if "://" in url else "file"
+    fs = fsspec.filesystem("blockcache", target_protocol=protocol, cache_storage=REMOTE_CACHE_DIR)
+    files = [fs.open(path, 'rb') for path in sorted(fs.glob(url.rstrip('/') + "/*.nc"))]
+
+    select_point = point_selector(coords) if coords is not None else None
+    def preprocess(ds):
+        if variables is not None:
+            ds = ds[variables]
+        if select_point is not None:
+            ds = select_point(ds)
+        return ds
+
+    # netCDF4 cannot read from file objects, h5netcdf reads the same (HDF5-based) files
+    ds = xr.open_mfdataset(files, engine="h5netcdf", preprocess=preprocess)
+    return chunk_for_layout(ds, layout) if coords is None else ds
+
+def plan_chunks(sizes, itemsize=4, layout="time", target_mb=None):
+    '''
+    chunk sizes {dim: size} of about target_mb (default CHUNK_TARGET_MB) for a (time, lat, lon, ...) array
+    layout 'time': the whole time axis in every chunk, square-ish lat/lon blocks
+    layout 'space': whole lat/lon grids in every chunk, split along time
+    '''
+    target = (target_mb or CHUNK_TARGET_MB) * 1024**2 // itemsize # elements per chunk
+    space_dims = [dim for dim in sizes if dim != 'time']
+    ntime = sizes.get('time', 1)
+    if layout == "space":
+        cells = int(np.prod([sizes[dim] for dim in space_dims]))
+        return {'time': int(min(ntime, max(1, target // max(cells, 1)))), **{dim: -1 for dim in space_dims}}
+
+    assert layout == "time", "Unknown chunk layout {}".format(layout)
+    cells = max(1, target // ntime)
+    chunks = {'time': -1}
+    # split the cells evenly over the space dimensions, e.g. sqrt(cells) x sqrt(cells) for lat/lon
+    for i, dim in enumerate(space_dims):
+        per_dim = max(1, int(round(cells ** (1 / (len(space_dims) - i)))))
+        chunks[dim] = int(min(sizes[dim], per_dim))
+        cells = max(1, cells // chunks[dim])
+    return chunks
+
+def chunk_for_layout(ds, layout=None, target_mb=None):
+    '''
+    rechunk a dataset for the access pattern layout ('time' / 'space', None keeps the file chunks), see plan_chunks
+    '''
+    if layout is None:
+        return ds
+    itemsize = max([var.dtype.itemsize for var in ds.data_vars.values()] or [4])
+    chunks = plan_chunks(dict(ds.sizes), itemsize, layout, target_mb)
+    print("Chunk plan ({}-major): {}".format(layout, chunks))
+    return ds.chunk(chunks)
+
+def time_series_chunks(ds, space_chunk=None):
+    '''
+    rechunk dataset for time-series access: the full time axis in each chunk and small
+    lat/lon chunks, so that reading one location only touches one chunk
+    '''
+    space_chunk = space_chunk or ZARR_SPACE_CHUNK
+    chunks = {dim: (-1 if dim == 'time' else space_chunk) for dim in ds.dims}
+    print("Rechunking dataset to {}".format(chunks))
+    return ds.chunk(chunks)
+
+@timed
+def write_zarr(ds, store):
+    '''
+    write dataset to a (local or s3://) Zarr store, keeping the dataset's dask chunks
+    see: https://xarray.pydata.org/en/stable/generated/xarray.Dataset.to_zarr.html
+    '''
+    ds = ds.copy()
+    for var in ds.variables.values():
+        # netcdf chunk/compression encodings do not carry over to zarr
+        for key in ['chunksizes', 'chunks', 'zlib', 'complevel', 'shuffle', 'contiguous', 'preferred_chunks']:
+            var.encoding.pop(key, None)
+    print("Writing Zarr store {}".format(store))
+    ds.to_zarr(store, mode='w', consolidated=True)
+    return store
+
+@timed
+def import_zarr(store, coords=None, cache=False):
+    '''
+    open a Zarr store written by write_zarr, either a local path or an s3:// uri (read in place via s3fs)
+    optionally only select the grid cell nearest to coords (lat, lon), see point_selector
+    cache: keep fetched chunks in REMOTE_CACHE_DIR
+    '''
+    print("Import Zarr store: {}".format(store))
+    if cache:
+        ds = xr.open_zarr("simplecache::" + store, consolidated=True, storage_options={"simplecache": {"cache_storage": REMOTE_CACHE_DIR}})
+    else:
+        ds = xr.open_zarr(store, consolidated=True)
+    if coords is not None:
+        ds = point_selector(coords)(ds)
+    return ds
+
+def point_selector(coords):
+    '''
+    return an open_mfdataset preprocess hook that keeps only the grid cell nearest to
+    coords (lat, lon) in every file, so calendar processing runs on a 1-d series
+    lat/lon dimensions are kept with length 1 so that select_location_mdf still applies
+    the nearest cell is found on the sphere, see grid_index
+    '''
+    def select_point(ds):
+        cells, _ = grid_index(ds).query(coords[0], coords[1])
+        return ds.isel({dim: [int(positions[0])] for dim, positions in cells.items()})
+    return select_point
 
 
 ##################### data processing #####################
@@ -43,9 +206,11 @@ def remove_feb_29_30(ds):
     if time index contains Feb 29 or Feb 30 as in some cftime formats, it cannot be converted,
     therefore these are removed from all models + reference dataset
     '''
-    feb_29 = ds.time.values[(ds.time.dt.month == 2) & (ds.time.dt.day == 29)]
-    feb_30 = ds.time.values[(ds.time.dt.month == 2) & (ds.time.dt.day == 30)]
-    return ds.drop_sel(time=feb_29).drop_sel(time=feb_30)
+    year, month, day = time_fields(ds.time.values)
+    keep = ~((month == 2) & ((day == 29) | (day == 30)))
+    if keep.all():
+        return ds
+    return ds.isel(time=np.flatnonzero(keep))
 
 def normalize_time(ds):
     '''
@@ -71,15 +236,109 @@ def rename_coord(ds, names_dict):
 
 def cf_to_datetime(ds):
     '''
-    take cftime calendar types and convert to datetime64
+    take cftime calendar types and convert to datetime64 (same year/month/day, time of day dropped)
     note: requires Feb 29 and Feb 30 to be removed first
     '''
-    datetimeindex = ds.indexes['time'].to_datetimeindex().normalize()
+    datetimeindex = pd.DatetimeIndex(fields_to_datetime64(*time_fields(ds.time.values)))
     ds_dt=ds
     ds_dt['time']= ('time', datetimeindex)
     assert len(ds.time) == len(ds_dt.time)
     return ds_dt
 
+##################### calendar engine #####################
+
+# cumulative days before each month in the fixed-length cftime calendars
+MONTH_STARTS = {
+    365: np.cumsum([0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]),
+    366: np.cumsum([0, 31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]),
+    360: np.arange(0, 390, 30),
+}
+YEAR_LENGTHS = {"noleap": 365, "365_day": 365, "all_leap": 366, "366_day": 366, "360_day": 360}
+# calendars whose dates (after 1582-10-15) are the datetime64 (proleptic gregorian) dates
+GREGORIAN_CALENDARS = {"standard", "gregorian", "proleptic_gregorian"}
+GREGORIAN_START = (np.datetime64('1582-10-15') - np.datetime64('1970-01-01')).astype(int)
+
+REINDEX_CACHE_SIZE = 32
+_reindex_cache = OrderedDict()
+
+def time_fields(times):
+    '''
+    (year, month, day) integer arrays of an array of datetime64 or cftime dates (any calendar)
+    cftime dates are decoded to integer day offsets by cftime.date2num and split with NumPy arithmetic,
+    only calendars without a fixed year length other than the gregorian ones (e.g. julian) are read field by field
+    '''
+    times = np.asarray(times)
+    if np.issubdtype(times.dtype, np.datetime64):
+        days = times.astype('datetime64[D]')
+    elif len(times) == 0:
+        return (np.array([], dtype=int),) * 3
+    else:
+        cal_name = getattr(times.flat[0], 'calendar', None)
+        if cal_name is None:
+            raise TypeError("Unknown calendar type {}".format(type(times.flat[0])))
+        if cal_name in YEAR_LENGTHS:
+            year_length = YEAR_LENGTHS[cal_name]
+            offsets = np.floor(cftime.date2num(times, "days since 1970-01-01", calendar=cal_name)).astype(np.int64)
+            year, day_of_year = np.divmod(offsets, year_length)
+            month = np.searchsorted(MONTH_STARTS[year_length], day_of_year, side='right')
+            day = day_of_year - MONTH_STARTS[year_length][month - 1] + 1
+            return year + 1970, month, day
+        if cal_name in GREGORIAN_CALENDARS:
+            offsets = np.floor(cftime.date2num(times, "days since 1970-01-01", calendar=cal_name)).astype(np.int64)
+        if cal_name in GREGORIAN_CALENDARS and (cal_name == "proleptic_gregorian" or offsets.min() >= GREGORIAN_START):
+            days = np.datetime64('1970-01-01', 'D') + offsets
+        else:
+            fields = np.array([(t.year, t.month, t.day) for t in times.ravel()], dtype=np.int64).reshape(-1, 3)
+            return fields[:, 0], fields[:, 1], fields[:, 2]
+
+    years = days.astype('datetime64[Y]')
+    months = days.astype('datetime64[M]')
+    return years.astype(np.int64) + 1970, (months - years).astype(np.int64) + 1, (days - months).astype(np.int64) + 1
+
+def fields_to_datetime64(year, month, day):
+    '''
+    datetime64[ns] dates from year, month, day arrays (dates must exist in the gregorian calendar)
+    '''
+    months = (np.asarray(year) - 1970) * 12 + np.asarray(month) - 1
+    days = months.astype('datetime64[M]').astype('datetime64[D]') + (np.asarray(day) - 1)
+    return days.astype('datetime64[ns]')
+
+def ffill_indexer(source, target):
+    '''
+    positions in the (sorted) source times of the last time <= each target time, -1 where there is none,
+    i.e. the index array of reindex(method="ffill"), cached per pair of time axes
+    '''
+    source = np.asarray(source, dtype='datetime64[ns]')
+    target = np.asarray(target, dtype='datetime64[ns]')
+    key = hashlib.sha1(source.tobytes() + b'|' + target.tobytes()).hexdigest()
+    if key in _reindex_cache:
+        _reindex_cache.move_to_end(key)
+        return _reindex_cache[key]
+
+    assert np.all(source[1:] >= source[:-1]), "time index must be sorted to forward fill"
+    indexer = np.searchsorted(source, target, side='right') - 1
+    _reindex_cache[key] = indexer
+    if len(_reindex_cache) > REINDEX_CACHE_SIZE:
+        _reindex_cache.popitem(last=False)
+    return indexer
+
+def reindex_time_ffill(ds, reference):
+    '''
+    ds.reindex_like(reference, method="ffill") via the cached time index array
+    (any other dimensions indexed in both are reindexed the usual way)
+    '''
+    indexer = ffill_indexer(ds.time.values, reference.time.values)
+    missing = indexer < 0
+    reindexed = ds.isel(time=np.where(missing, 0, indexer))
+    reindexed = reindexed.assign_coords(time=reference.time.values)
+    if missing.any():
+        reindexed = reindexed.where(xr.DataArray(~missing, dims='time', coords={'time': reference.time.values}))
+
+    other_dims = [dim for dim in reference.indexes if dim != 'time' and dim in ds.indexes]
+    if other_dims:
+        reindexed = reindexed.reindex({dim: reference.indexes[dim] for dim in other_dims}, method="ffill")
+    return reindexed
+
 def process_reference(ds):
     '''
     data processing steps for reference (i.e. ERA5) dataset
@@ -91,6 +350,7 @@ def process_reference(ds):
     c = rename_coord(b, names_dict)
     return c
 
+@timed
 def process_models(ds, reference):
     '''
     data processing steps for climate model dataset
@@ -100,29 +360,120 @@ def process_models(ds, reference):
     '''
     #a = import_dataset(ds)
     b = remove_feb_29_30(ds)#(a)
-    if calendar_type(b) in {np.datetime64}:
+    if np.issubdtype(b.time.dtype, np.datetime64):
         c = b
-    elif calendar_type(b) in {cftime._cftime.DatetimeNoLeap, cftime._cftime.Datetime360Day}:
-        # most common types in cmip5/cmip6 - may need to search for any others
-        c = cf_to_datetime(b)
     else:
-        print("Error: unknown calendar type")
-    d = c.reindex_like(reference, method="ffill")
+        # any cftime calendar (noleap, 360_day, all_leap, julian, ...), see time_fields
+        c = cf_to_datetime(b)
+    d = reindex_time_ffill(c, reference)
     e = normalize_time(d)
     return e
 
 ##################### data selection #####################
 
-def get_coords(city:str):
+# offline geocoding: bundled city,lat,lon table (gazetteer.csv, the locations of loop_scripts, regenerate with export_gazetteer)
+# + on-disk cache of online lookups, kept next to the dataset cache so it persists where that volume does
+GAZETTEER_PATH = os.environ.get("CLIMATE_GAZETTEER", os.path.join(os.path.dirname(os.path.abspath(__file__)), "gazetteer.csv"))
+GEOCODE_CACHE_PATH = os.environ.get("CLIMATE_GEOCODE_CACHE", os.path.join(
+    os.environ.get("CLIMATE_DATASET_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "climate", "datasets")), ".geocode_cache.json"))
+_gazetteer = None
+
+def city_key(city:str):
     '''
-    return lat, lon for city
+    normalised lookup key for city names (case and whitespace insensitive)
+    '''
+    return " ".join(city.split()).lower()
+
+def load_gazetteer():
+    '''
+    return in-memory {city_key: (lat, lon)} table, read once from the gazetteer csv
+    (columns city,lat,lon) and the geocode cache, if they exist
+    '''
+    global _gazetteer
+    if _gazetteer is None:
+        _gazetteer = {}
+        if os.path.exists(GAZETTEER_PATH):
+            with open(GAZETTEER_PATH, newline='', encoding='utf-8') as f:
+                for row in csv.DictReader(f):
+                    _gazetteer[city_key(row['city'])] = (float(row['lat']), float(row['lon']))
+        if os.path.exists(GEOCODE_CACHE_PATH):
+            with open(GEOCODE_CACHE_PATH, encoding='utf-8') as f:
+                for key, coords in json.load(f).items():
+                    _gazetteer.setdefault(key, tuple(coords))
+    return _gazetteer
+
+def save_geocode_cache(new_coords):
+    '''
+    merge {city_key: (lat, lon)} into the on-disk geocode cache
+    '''
+    cached = {}
+    if os.path.exists(GEOCODE_CACHE_PATH):
+        with open(GEOCODE_CACHE_PATH, encoding='utf-8') as f:
+            cached = json.load(f)
+    cached.update({key: list(coords) for key, coords in new_coords.items()})
+
+    os.makedirs(os.path.dirname(GEOCODE_CACHE_PATH), exist_ok=True)
+    tmp_path = "{}.tmp-{}".format(GEOCODE_CACHE_PATH, os.getpid()) # tasks sharing the cache write it concurrently
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(cached, f, indent=1, ensure_ascii=False)
+    os.replace(tmp_path, GEOCODE_CACHE_PATH)
+
+def geocode_online(cities):
+    '''
+    return {city_key: (lat, lon)} from the Nominatim web geocoder, rate-limited to 1 request/s
     see: https://geopy.readthedocs.io/en/stable/#nominatim
     '''
     geolocator = Nominatim(user_agent='http')
-    location = geolocator.geocode(city)
-    latitude, longitude = location.latitude, location.longitude
-    #print(location, (latitude, longitude))
-    return (latitude, longitude)
+    geocode = RateLimiter(geolocator.geocode, min_delay_seconds=1) if len(cities) > 1 else geolocator.geocode
+    found = {}
+    for city in cities:
+        location = geocode(city)
+        if location is None:
+            print("Error: could not geocode city {}".format(city))
+            continue
+        found[city_key(city)] = (location.latitude, location.longitude)
+    return found
+
+@timed
+def resolve_many(cities):
+    '''
+    return {city: (lat, lon)} for a list of cities, only cities missing from the
+    gazetteer/cache are looked up online (and then cached)
+    '''
+    gazetteer = load_gazetteer()
+    missing = [city for city in cities if city_key(city) not in gazetteer]
+    if len(missing) > 0:
+        print("Geocoding {} cities online: {}".format(len(missing), missing))
+        found = geocode_online(missing)
+        gazetteer.update(found)
+        save_geocode_cache(found)
+    return {city: gazetteer[city_key(city)] for city in cities if city_key(city) in gazetteer}
+
+def export_gazetteer(cities, path=GAZETTEER_PATH):
+    '''
+    write city,lat,lon table for a list of cities (e.g. to bundle with the container),
+    raises ValueError and leaves path unchanged if any city could not be geocoded
+    '''
+    coords = resolve_many(cities)
+    missing = [city for city in cities if city not in coords]
+    if missing:
+        raise ValueError("Could not geocode {} of {} cities, gazetteer not written: {}".format(len(missing), len(cities), missing))
+
+    tmp_path = "{}.tmp-{}".format(path, os.getpid())
+    with open(tmp_path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['city', 'lat', 'lon'])
+        for city, (lat, lon) in coords.items():
+            writer.writerow([city, lat, lon])
+    os.replace(tmp_path, path)
+    return path
+
+def get_coords(city:str):
+    '''
+    return lat, lon for city
+    looked up in the local gazetteer/cache first, see resolve_many
+    '''
+    return resolve_many([city])[city]
 
 def select_time(ds, start, end):
     '''
@@ -131,26 +482,58 @@ def select_time(ds, start, end):
     '''
     return ds.sel(time=slice(start, end))
 
+def select_region(ds, region):
+    '''
+    select the grid cells within region [lat_min, lat_max, lon_min, lon_max] (longitudes in any convention,
+    lon_min > lon_max crosses the dateline), cells outside of it are masked (nan) on curvilinear grids
+    '''
+    lat_min, lat_max, lon_min, lon_max = region
+    lat_name, lon_name = lat_lon_names(ds)
+    lat, lon = ds[lat_name], ds[lon_name]
+    in_lat = (lat >= lat_min) & (lat <= lat_max)
+    in_lon = (lon - lon_min) % 360 <= (lon_max - lon_min) % 360 if lon_max - lon_min < 360 else xr.ones_like(lon, dtype=bool)
+    if lat.ndim == 1 and lon.ndim == 1:
+        return ds.isel({lat.dims[0]: in_lat.values, lon.dims[0]: in_lon.values})
+    return ds.where(in_lat & in_lon)
+
+@timed
 def select_location_mdf(ds, city, start=None, end=None): #, to_pandas=False):
     '''
     select 1-d time series for specified city, optionally select time range
     returns DataArray
+    the nearest grid cell is found on the sphere (any longitude convention or curvilinear grid, see grid_index),
+    its great-circle distance to the city is kept as the 'grid_distance_km' coordinate
     *** should this output a pandas df? unsure where to convert
     '''
-    coords = get_coords(city)
-    # note: model + ERA latitudes are -90 -> +90, longitudes are 0 -> +360
-    da = ds.sel(lat=coords[0], lon=180+coords[1], method='nearest')
+    lat, lon = get_coords(city)
+    cells, distance = grid_index(ds).query(lat, lon)
+    da = ds.isel({dim: int(positions[0]) for dim, positions in cells.items()})
+    da = da.assign_coords(grid_distance_km=float(distance[0]))
     da_sl = select_time(da, start, end)#.to_dataframe()
     return(da_sl)
 
+@timed
+def select_locations_mdf(ds, cities, start=None, end=None):
+    '''
+    select time series for a list of cities in one vectorized (pointwise) selection,
+    optionally select time range
+    returns Dataset with a 'location' dimension labelled by city (and the 'grid_distance_km' to each city)
+    '''
+    coords = resolve_many(cities)
+    indexers, distance = nearest_cells(ds, [coords[city][0] for city in cities], [coords[city][1] for city in cities], 'location', cities)
+    da = ds.isel(indexers).assign_coords(grid_distance_km=distance)
+    return select_time(da, start, end)
+
 def get_nearest(ds, latitude, longitude):
     '''
     get grid-point nearest to specified lat, lon
     (i.e. for checking how far city coordinate is from closest grid-point in dataset)
+    see grid_index for the great-circle distance
     '''
-    lat = ds.sel(lat=latitude, lon=longitude, method="nearest")['lat'].values
-    lon = ds.sel(lat=latitude, lon=longitude, method="nearest")['lon'].values
-    return float(lat), float(lon)
+    index = grid_index(ds)
+    cells, _ = index.query(latitude, longitude)
+    lat, lon = index.cell_coords(cells)
+    return float(lat[0]), float(lon[0])
 
 
 
@@ -210,11 +593,11 @@ def delta_correction(model, reference, past, future):
     returns reference + bias-corrected model dataframe
     '''
 
-    reference_past = reference.loc[past[0],past[1]].tas
-    reference_future = reference.loc[future[0],future[1]].tas
+    reference_past = reference.loc[dict(time=slice(past[0],past[1]))].tas
+    reference_future = reference.loc[dict(time=slice(future[0],future[1]))].tas
 
-    model_past = model.loc[past[0],past[1]].tas
-    model_future = model.loc[future[0],future[1]].tas
+    model_past = model.loc[dict(time=slice(past[0],past[1]))].tas
+    model_future = model.loc[dict(time=slice(future[0],future[1]))].tas
 
     corrected = model_future + (np.nanmean(reference_past) - np.nanmean(model_past))
 
@@ -227,55 +610,81 @@ def delta_correction(model, reference, past, future):
     #df.rename(columns={"reference": "T_obs", "model": "T_model"}, inplace=True)
     return corrected, reference_future
 
-def relative_delta_correction(model_name, model, reference, past, future):
-    '''
-    relative mean-shift bias correction
-    i.e. model_future = model_future * (observation_past.mean / model_past.mean)
-    this is important for e.g. precipitation to avoid returning unphysical < 0 values
-    returns reference + bias-corrected model dataframe
-    '''
-
-    reference_past = reference.loc[past[0]:past[1]].tas
-    reference_future = reference.loc[future[0]:future[1]].tas
-
-    model_past = model.loc[past[0]:past[1]].tas
-    model_future = model.loc[future[0]:future[1]].tas
-
-    corrected = model_future * (np.nanmean(reference_past) / np.nanmean(model_past))
-
-    #corrected = (model_future * (np.nanmean(reference_past) / np.nanmean(model_past))).to_frame("model")
-    #corrected['model']=model_name
+##################### reordering utils #####################
 
-    #reference_df = reference_future.to_frame("reference")
+# reorder() switches to the banded sparse solver when window < N * SPARSE_BAND_FRACTION
+SPARSE_BAND_FRACTION = 0.25
 
-    #df = pd.concat([reference_df.t2m, corrected_df.t2m, corrected_df.model], axis=1)
-    #df.rename(columns={"reference": "T_obs", "model": "T_model"}, inplace=True)
-    return corrected, reference_future
+# reorderings are independent of the cost threshold, so keep the most recent ones around
+REORDER_CACHE_SIZE = 32
+_reorder_cache = OrderedDict()
 
-##################### reordering utils #####################
+# approximate 'chunked' reordering: block length and seam overlap as multiples of the window
+CHUNK_BLOCK_FACTOR = 20
+CHUNK_OVERLAP_FACTOR = 2
+CHUNK_MIN_BLOCK = 2048 # days, smaller blocks cost more in solver calls and inter-process transfers than they save
+# processes of a chunked reordering (None: one per cpu), lowered in the pipeline's worker processes, see pipeline
+CHUNK_PROCESSES = None
 
 def levenshtein(a,b):
     '''
     Calculates the Levenshtein matching distance between series a and b
     see: https://en.wikipedia.org/wiki/Levenshtein_distance
     '''
-    n, m = len(a), len(b)
-    if n > m:
-        # Make sure n <= m, to use O(min(n,m)) space
-        a,b = b,a
-        n,m = m,n
+    return int(edit_distance(list(a), list(b)))
 
-    current = range(n+1)
-    for i in range(1,m+1):
-        previous, current = current, [i]+[0]*n
-        for j in range(1,n+1):
-            add, delete = previous[j]+1, current[j-1]+1
-            change = previous[j-1]
-            if a[j-1] != b[i-1]:
-                change = change + 1
-            current[j] = min(add, delete, change)
+def edit_distance(a, b, tolerance=0., band=None):
+    '''
+    Levenshtein distance between series a and b, see edit_distance_batch
+    '''
+    return edit_distance_batch(np.asarray(a)[None, :], np.asarray(b)[None, :], tolerance, band)[0]
 
-    return current[n]
+def edit_distance_batch(A, B, tolerance=0., band=None):
+    '''
+    Levenshtein distance for a batch of series pairs, vectorized over the batch and each DP row
+    A: (batch, n) or (n,), B: (batch, m) or (m,) e.g. every model against one reference
+    tolerance: values with |a - b| <= tolerance count as equal (0 -> exact equality)
+    band: only allow matching a_i to b_j for |i - j| <= band (e.g. the half-width (window - 1) // 2 of the reordering window),
+          which also limits the work per row to O(band)
+    each row i is computed from the previous row in closed form: the insertion chain
+    D[i][j] = min_k (t[k] + j - k) is a running minimum of t[k] - k
+    '''
+    A = np.asarray(A)
+    B = np.asarray(B)
+    A = A[None, :] if A.ndim == 1 else A
+    B = B[None, :] if B.ndim == 1 else B
+    batch = max(len(A), len(B))
+    A = np.broadcast_to(A, (batch, A.shape[1]))
+    B = np.broadcast_to(B, (batch, B.shape[1]))
+    n, m = A.shape[1], B.shape[1]
+
+    band = n + m if band is None else max(int(band), abs(n - m))
+    INF = n + m + 1
+
+    previous = np.full((batch, m+1), INF, dtype=np.int64)
+    current = np.full((batch, m+1), INF, dtype=np.int64)
+    previous[:, :min(m, band)+1] = np.arange(min(m, band)+1)
+
+    for i in range(1, n+1):
+        lo, hi = max(0, i-band), min(m, i+band)
+        j = np.arange(lo, hi+1)
+        s = max(lo, 1)
+
+        if tolerance:
+            mismatch = np.abs(B[:, s-1:hi] - A[:, i-1:i]) > tolerance
+        else:
+            mismatch = B[:, s-1:hi] != A[:, i-1:i]
+
+        t = np.empty((batch, hi-lo+1), dtype=np.int64)
+        if lo == 0:
+            t[:, 0] = i
+        # delete / substitute (or keep) from the previous row
+        t[:, s-lo:] = np.minimum(previous[:, s:hi+1] + 1, previous[:, s-1:hi] + mismatch)
+        # insert, cells outside the band are never read again so are left as they are
+        current[:, lo:hi+1] = np.minimum.accumulate(t - j, axis=1) + j
+        previous, current = current, previous
+
+    return previous[:, m]
 
 def band_matrix(window: int, N):
     '''
@@ -295,32 +704,174 @@ def band_matrix(window: int, N):
         a[a==0]='nan'
         return a
 
-def reorder(A, B, window):
+def banded_cost_matrix(A, B, window, rows=None, cols=None):
+    '''
+    return sparse (CSR) cost matrix holding only the entries (A_i - B_j)**2 for which
+    row index i and column index j are within +/- (window-1)/2 days of each other
+    rows, cols optionally give the time indices of A, B (default: 0..len-1, cols must be sorted)
+    '''
+    w = int((window - 1)/2)
+    rows = np.arange(len(A)) if rows is None else np.asarray(rows)
+    cols = np.arange(len(B)) if cols is None else np.asarray(cols)
+
+    # first/last allowed column of each row inside the band
+    lo = np.searchsorted(cols, rows - w, side='left')
+    hi = np.searchsorted(cols, rows + w, side='right')
+    counts = hi - lo
+
+    row_index = np.repeat(np.arange(len(rows)), counts)
+    starts = np.repeat(lo - np.cumsum(counts) + counts, counts)
+    column_index = np.arange(counts.sum()) + starts
+    values = (A[row_index] - B[column_index])**2
+
+    indptr = np.concatenate([[0], np.cumsum(counts)])
+    return csr_matrix((values, column_index, indptr), shape=(len(rows), len(cols)))
+
+def sparse_assignment(cost_matrix):
+    '''
+    exact min-cost full matching for a sparse (CSR) cost matrix, returns row, column indices
+    costs are rescaled to integers (exactly representable in float64 for sums over N rows)
+    and shifted by +1, so exact matches are not dropped as implicit zeros and the solver
+    does not stall on near-tied floating point costs
+    see: https://docs.scipy.org/doc/scipy/reference/generated/scipy.sparse.csgraph.min_weight_full_bipartite_matching.html
+    '''
+    N = cost_matrix.shape[0]
+    max_cost = cost_matrix.data.max() if cost_matrix.nnz else 0.
+    scale = float(2**52 // (4*(N+1))) / max_cost if max_cost > 0 else 1.
+
+    integer_costs = cost_matrix.copy()
+    integer_costs.data = np.round(cost_matrix.data * scale) + 1.
+    return min_weight_full_bipartite_matching(integer_costs)
+
+@timed
+def reorder_indices(A, B, window, method='auto'):
+    '''
+    return column indices of the optimal matching of series B to series A, restricted
+    to sliding time windows of +/- (window-1)/2 days around each point
+    method 'dense'  -> full NxN cost matrix + linear_sum_assignment, O(N^2) memory
+    method 'sparse' -> banded sparse min-cost bipartite matching, O(N*window) memory
+    method 'auto'   -> 'sparse' when the band covers a small fraction of the matrix
+    method 'chunked' -> approximate, see chunked_reorder_indices
+    '''
+    A = np.asarray(A, dtype=float)
+    B = np.asarray(B, dtype=float)
+    N = len(A)
+
+    if window % 2 == 0:
+        window += 1
+
+    if method == 'auto':
+        method = 'sparse' if window < N * SPARSE_BAND_FRACTION else 'dense'
+
+    if method == 'sparse':
+        row_index, column_index = sparse_assignment(banded_cost_matrix(A, B, window))
+
+    elif method == 'chunked':
+        column_index = chunked_reorder_indices(A, B, window)
+
+    elif method == 'dense':
+        cost_matrix = (A[:, None] - B[None, :])**2
+        exclude_cost = cost_matrix.max()*2 # set arbitrarily high cost to prevent reordering of these points
+
+        # generate band matrix with 'nan' outside allowed sliding window
+        b = band_matrix(window, cost_matrix.shape[0])
+        banded_cost = cost_matrix * b
+        banded_cost[np.isnan(banded_cost)] = exclude_cost
+
+        row_index, column_index = linear_sum_assignment(np.abs(banded_cost))
+
+    else:
+        raise ValueError("unknown reorder method '{}', select 'auto', 'sparse', 'dense', 'chunked'".format(method))
+
+    return column_index
+
+def _assign_block(block):
+    '''
+    solve the banded assignment of one block, given as its A values (consecutive days), its B values
+    and the day of each B value relative to the first A day
+    returns the position in the block's B values matched to each A value
+    '''
+    A, B, cols, window = block
+    row_index, column_index = sparse_assignment(banded_cost_matrix(A, B, window, cols=cols))
+    return column_index
+
+@timed
+def chunked_reorder_indices(A, B, window, block_size=None, overlap=None, processes=None):
+    '''
+    approximate reorder_indices for small windows, solved block-wise on a process pool
+    1. split the series into independent time blocks and solve each block's assignment
+    2. re-solve a seam of +/- overlap days around every block boundary, matching the seam
+       rows to the columns they currently hold, so matches can cross the block boundaries
+    every step keeps a valid permutation inside the band and never increases the total cost,
+    so the result is an upper bound on the exact optimum (see compare_reorderings)
+    only the values of a block are sent to the workers, and a series that fits in one block
+    is solved exactly with the sparse solver
+    '''
+    A = np.asarray(A, dtype=float)
+    B = np.asarray(B, dtype=float)
+    N = len(A)
+
+    if window % 2 == 0:
+        window += 1
+    overlap = overlap or CHUNK_OVERLAP_FACTOR * window
+    block_size = max(block_size or max(CHUNK_BLOCK_FACTOR * window, CHUNK_MIN_BLOCK), 2 * overlap)
+    if block_size >= N:
+        return reorder_indices(A, B, window, method='sparse')
+
+    boundaries = list(range(0, N, block_size))
+    block_rows = [np.arange(start, min(start + block_size, N)) for start in boundaries]
+    blocks = [(A[rows], B[rows], rows - rows[0], window) for rows in block_rows]
+
+    processes = processes or CHUNK_PROCESSES or os.cpu_count() or 1
+    # many small blocks for small windows: send them in batches
+    chunksize = max(1, len(boundaries) // (4 * processes))
+    with (ProcessPoolExecutor(max_workers=processes) if processes > 1 else nullcontext()) as pool:
+        solve = partial(pool.map, _assign_block, chunksize=chunksize) if pool is not None else partial(map, _assign_block)
+        column_index = np.concatenate([rows[positions] for rows, positions in zip(block_rows, solve(blocks))])
+
+        seam_rows, seam_cols, seams = [], [], []
+        for boundary in boundaries[1:]:
+            rows = np.arange(max(boundary - overlap, 0), min(boundary + overlap, N))
+            cols = np.sort(column_index[rows])
+            seam_rows.append(rows)
+            seam_cols.append(cols)
+            seams.append((A[rows], B[cols], cols - rows[0], window))
+        for rows, cols, positions in zip(seam_rows, seam_cols, solve(seams)):
+            column_index[rows] = cols[positions]
+
+    return column_index
+
+def reorder(A, B, window, method='auto'):
     '''
     apply optimal matching algorithm to series B to match series A
     for sliding time windows up to specified window.
     windows must be odd numbers (symmetrical around central day)
     threshold_type 'lower' -> match high temperature extremes
     threshold_type 'upper' -> match low temperature extremes
+    see reorder_indices for the available solver methods
+    returns the permutation as an int32 index array, i.e. B reordered is B[permutation]
     '''
+    return np.asarray(reorder_indices(A, B, window, method), dtype=np.int32)
 
-    cost_matrix = (A[:, None] - B[None, :])**2
-    exclude_cost = cost_matrix.max()*2 # set arbitrarily high cost to prevent reordering of these points
-
-    if window % 2 == 0:
-        window += 1
-    #windows = np.arange(1, max_window+1, 2)
+def cached_reorder_indices(A, B, window, method='auto'):
+    '''
+    reorder_indices with a bounded in-memory cache keyed by the contents of A, B and window
+    (i.e. evaluating several thresholds against the same series solves the assignment once)
+    '''
+    A = np.ascontiguousarray(A, dtype=float)
+    B = np.ascontiguousarray(B, dtype=float)
+    key = hashlib.sha1(A.tobytes() + b'|' + B.tobytes() + '|{}|{}'.format(window, method).encode()).hexdigest()
 
-    #for window in windows: ## outputs should be per time window ?
-        # generate band matrix with 'nan' outside allowed sliding window
-    b = band_matrix(window, cost_matrix.shape[0])
-    banded_cost_matrix = cost_matrix * b
-    banded_cost_matrix[np.isnan(banded_cost_matrix)] = exclude_cost
-    
-    row_index, column_index = linear_sum_assignment(np.abs(banded_cost_matrix))
-    B_matched = [B[i] for i in column_index]
+    if key in _reorder_cache:
+        _reorder_cache.move_to_end(key)
+        print("Reusing cached reordering for window {}".format(window))
+        return _reorder_cache[key]
 
-    return B_matched
+    column_index = reorder_indices(A, B, window, method)
+    _reorder_cache[key] = column_index
+    if len(_reorder_cache) > REORDER_CACHE_SIZE:
+        _reorder_cache.popitem(last=False)
+    return column_index
 
 def rms(A, B):
     '''
@@ -328,45 +879,114 @@ def rms(A, B):
     '''
     return ((A-B)**2).mean()**0.5
 
-def threshold_cost(A, B, threshold, threshold_type):
+def threshold_cost(A, B, threshold, threshold_type, cost_metric='rms', tolerance=0., band=None):
     '''
     calculate rms (?) cost of B wrt A above/below specified threshold
     threshold_type = "lower" i.e. evaluate high-temperature extremes, and vice-versa
+    cost_metric 'rms' or 'edit' (edit distance with numeric tolerance and band, see edit_distance_batch)
+    the band is applied to the selected values, whose positions are not day offsets once points are excluded,
+    so with a threshold the banded edit distance is an approximation (an upper bound) of the unbanded one
     '''
 
     if threshold_type == 'none':
-        include_indices = [i for i in range(len(B))]
+        include = np.ones(len(B), dtype=bool)
 
     elif threshold_type == 'lower':
-        exclude_indices = [i for i in range(len(B)) if B[i] < threshold] #???
-        include_indices = [i for i in range(len(B)) if B[i]>= threshold]
+        include = B >= threshold
 
     elif threshold_type == 'upper':
-        include_indices = [i for i in range(len(B)) if B[i] < threshold]
-        exclude_indices = [i for i in range(len(B)) if B[i]>= threshold]
+        include = B < threshold
 
     else:
         print("error: select threshold 'none', 'lower', 'upper'")
 
-    A_selected = A[include_indices]
-    B_selected = B[include_indices]
+    A_selected = A[include]
+    B_selected = B[include]
 
-    # if cost_metric == 'rms' ?
     print("Lengths of selected Reference(A) and Model(B) arrays here: A:{} B:{}".format(len(A_selected), len(B_selected)))
 
-    cost = rms(A_selected, B_selected)
+    if cost_metric == 'edit':
+        cost = edit_distance(A_selected, B_selected, tolerance, band)
+    else:
+        cost = rms(A_selected, B_selected)
 
     return cost
 
-def reordering_cost(A, B, window=7, threshold=10, threshold_type="lower"):
+def threshold_cost_curves(A, B, thresholds, threshold_types=('none', 'lower', 'upper')):
+    '''
+    rms cost of B wrt A for every threshold in an array of thresholds, in one vectorized pass
+    sorts B once and uses cumulative sums of squared errors, so each threshold is a lookup
+    returns {threshold_type: array of costs (nan where no points are selected)}
+    '''
+    A = np.asarray(A, dtype=float)
+    B = np.asarray(B, dtype=float)
+    thresholds = np.atleast_1d(np.asarray(thresholds, dtype=float))
+
+    order = np.argsort(B, kind='stable')
+    squared_errors = np.concatenate([[0.], np.cumsum((A[order] - B[order])**2)])
+    total, N = squared_errors[-1], len(B)
+
+    # number of points with B < threshold
+    below = np.searchsorted(B[order], thresholds, side='left')
+
+    curves = {}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for threshold_type in threshold_types:
+            if threshold_type == 'none':
+                curves[threshold_type] = np.full(len(thresholds), (total / N)**0.5)
+            elif threshold_type == 'lower':
+                curves[threshold_type] = ((total - squared_errors[below]) / (N - below))**0.5
+            elif threshold_type == 'upper':
+                curves[threshold_type] = (squared_errors[below] / below)**0.5
+            else:
+                print("error: select threshold 'none', 'lower', 'upper'")
+    return curves
+
+def reordering_cost(A, B, window=7, threshold=10, threshold_type="lower", method='auto', cost_metric='rms', tolerance=0.):
     '''
     combined function for reordering + calculate cost
     '''
-    B_matched = reorder(A, B, window)
+    costs, permutation = reordering_costs(A, B, window, [threshold], threshold_type, method, cost_metric, tolerance)
+    return costs[0], permutation
+
+@timed
+def reordering_costs(A, B, window=7, thresholds=[10], threshold_type="lower", method='auto', cost_metric='rms', tolerance=0.):
+    '''
+    reorder B once and calculate the cost for each of a list of thresholds
+    cost_metric 'rms' (vectorized over thresholds) or 'edit' (edit distance banded to the shifts the reordering allows,
+    see threshold_cost)
+    returns the costs and the reordering as an int32 permutation of B
+    '''
+    permutation = np.asarray(cached_reorder_indices(A, B, window, method), dtype=np.int32)
     np_A = np.array(A)
-    np_B_matched = np.array(B_matched)
-    cost = threshold_cost(np_A, np_B_matched, threshold, threshold_type)
-    return cost, B_matched
+    np_B_matched = np.asarray(B)[permutation]
+    if cost_metric == 'edit':
+        # reordering moves values by at most +/- (window - 1) // 2 days (even windows are widened by one, see reorder_indices)
+        band = window // 2
+        costs = [threshold_cost(np_A, np_B_matched, threshold, threshold_type, cost_metric, tolerance, band) for threshold in thresholds]
+    else:
+        costs = list(threshold_cost_curves(np_A, np_B_matched, thresholds, [threshold_type])[threshold_type])
+    return costs, permutation
+
+@timed
+def compare_reorderings(A, B, window=7, threshold=10, threshold_type="lower"):
+    '''
+    run exact and chunked (approximate) reordering and report how far the chunked
+    threshold_cost is from the exact one
+    '''
+    np_A = np.asarray(A, dtype=float)
+    np_B = np.asarray(B, dtype=float)
+    report = {"window": window, "threshold": float(threshold), "threshold_type": threshold_type}
+
+    for method in ['exact', 'chunked']:
+        start = time.time()
+        column_index = cached_reorder_indices(np_A, np_B, window, 'auto' if method == 'exact' else method)
+        report[method + "_seconds"] = time.time() - start
+        report[method + "_cost"] = float(threshold_cost(np_A, np_B[column_index], threshold, threshold_type))
+
+    report["absolute_error"] = report["chunked_cost"] - report["exact_cost"]
+    report["relative_error"] = report["absolute_error"] / report["exact_cost"] if report["exact_cost"] else 0.
+    return report
 
 ######################## Utils for Task Management #######################
 def load_object_from_s3(s3_client):
@@ -376,25 +996,115 @@ def load_object_from_s3(s3_client):
     return response
 
 
-def download_s3_folder(bucket, s3_folder, local_dir=None):
+# number of objects downloaded in parallel by download_s3_folder
+S3_DOWNLOAD_CONCURRENCY = int(os.environ.get("S3_DOWNLOAD_CONCURRENCY", 16))
+
+def etag_path(target):
+    '''
+    path of the hidden sidecar file recording the S3 ETag of a completely downloaded file
+    '''
+    return os.path.join(os.path.dirname(target), "." + os.path.basename(target) + ".etag")
+
+def is_downloaded(target, size, etag):
+    '''
+    check that a local file is a complete copy of the S3 object with this size and ETag
+    '''
+    if not os.path.exists(target) or os.path.getsize(target) != size or not os.path.exists(etag_path(target)):
+        return False
+    with open(etag_path(target)) as f:
+        return f.read() == etag
+
+def download_s3_object(client, bucket_name, key, target, size, etag):
+    '''
+    download one S3 object unless an identical copy exists, returns the number of bytes fetched
+    the object is fetched to a '.part' file and renamed when complete, so an interrupted
+    download is never mistaken for a finished one
+    '''
+    if is_downloaded(target, size, etag):
+        return 0
+    part = target + ".part"
+    try:
+        client.download_file(bucket_name, key, part)
+    except BaseException:
+        if os.path.exists(part):
+            os.remove(part)
+        raise
+    os.replace(part, target)
+    with open(etag_path(target), 'w') as f:
+        f.write(etag)
+    return size
+
+@timed
+def download_s3_folder(bucket, s3_folder, local_dir=None, concurrency=None):
     """
-    Taken from: https://stackoverflow.com/a/62945526
-    Download the contents of a folder directory
+    Adapted from: https://stackoverflow.com/a/62945526
+    Download the contents of a folder directory, in parallel, skipping files already
+    downloaded completely (same size and ETag), so interrupted downloads resume
     Args:
         bucket_name: the name of the s3 bucket
         s3_folder: the folder path in the s3 bucket
         local_dir: a relative or absolute directory path in the local file system
+        concurrency: number of parallel downloads (default S3_DOWNLOAD_CONCURRENCY)
+    Returns the number of bytes downloaded
     """
     print("Downloading S3 folder... {} / {}".format(bucket, s3_folder))
-    if os.path.exists(os.path.join(local_dir)):
-        print("Skipping the download because it's already downloaded")
-        return
-    for obj in bucket.objects.filter(Prefix=s3_folder):
-        print("Looping for downloading S3 object {}".format(obj))
-        target = obj.key if local_dir is None \
-            else os.path.join(local_dir, os.path.relpath(obj.key, s3_folder))
-        if not os.path.exists(os.path.dirname(target)):
-            os.makedirs(os.path.dirname(target))
-        if obj.key[-1] == '/':
+    objects = [obj for obj in bucket.objects.filter(Prefix=s3_folder) if obj.key[-1] != '/']
+    total_bytes = sum(obj.size for obj in objects)
+    print("Found {} objects ({:.1f} MB)".format(len(objects), total_bytes / 1e6))
+
+    # clients are thread-safe, resources are not
+    client = s3_client()
+    start = time.time()
+    downloaded_bytes = 0
+    with ThreadPoolExecutor(max_workers=concurrency or S3_DOWNLOAD_CONCURRENCY) as pool:
+        futures = []
+        for obj in objects:
+            target = obj.key if local_dir is None \
+                else os.path.join(local_dir, os.path.relpath(obj.key, s3_folder))
+            if os.path.dirname(target):
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+            futures.append(pool.submit(download_s3_object, client, bucket.name, obj.key, target, obj.size, obj.e_tag))
+
+        for i, future in enumerate(as_completed(futures)):
+            downloaded_bytes += future.result()
+            elapsed = time.time() - start
+            print("Downloaded {}/{} objects, {:.1f} MB fetched at {:.1f} MB/s".format(
+                i + 1, len(futures), downloaded_bytes / 1e6, downloaded_bytes / 1e6 / max(elapsed, 1e-9)))
+
+    count("bytes_downloaded", downloaded_bytes)
+    return downloaded_bytes
+
+def entry_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name)) for root, dirs, files in os.walk(path) for name in files)
+
+def evict_lru(directory, max_bytes, acquire=None, keep=()):
+    '''
+    delete the least-recently-used (oldest mtime) entries of directory until its size is below max_bytes
+    (used by the task and dataset caches, hidden names and '.tmp-' entries being written are skipped)
+    acquire: optional function entry -> lock (closed after the removal) or None to keep an entry that is in use
+    keep: names of entries that are in use and are never removed
+    '''
+    entries = [os.path.join(directory, name) for name in os.listdir(directory)
+               if '.tmp-' not in name and not name.startswith('.') and name not in keep]
+    entries = sorted(entries, key=os.path.getmtime)
+    sizes = {entry: entry_size(entry) for entry in entries}
+    total = sum(sizes.values())
+    for entry in entries:
+        if total <= max_bytes:
+            break
+        lock = acquire(entry) if acquire is not None else None
+        if acquire is not None and lock is None:
             continue
-        bucket.download_file(obj.key, target)
+        try:
+            print("Cache eviction: removing {} ({:.1f} MB)".format(entry, sizes[entry] / 1e6))
+            if os.path.isdir(entry):
+                shutil.rmtree(entry, ignore_errors=True)
+            else:
+                os.remove(entry)
+            total -= sizes[entry]
+        finally:
+            if lock is not None:
+                lock.close()
+    return total
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+
+"""
+Benchmarks for the processing and reordering hot paths, on synthetic data (runs fully offline).
+
+Times process_reference / process_models (noleap + 360_day models against an ERA5-like reference),
+select_location_mdf, apply_bias_correction, reorder over sweeps of series length N and window, and threshold_cost.
+Results are written as JSON and compared against a stored baseline: a case is flagged as a regression when it is
+more than --tolerance times slower than the baseline (and slower by more than --min-seconds).
+
+e.g.
+    python benchmarks/run_benchmarks.py                      # compare with benchmarks/baseline.json
+    python benchmarks/run_benchmarks.py --quick              # smaller data and sweeps
+    python benchmarks/run_benchmarks.py --update-baseline    # store the results as the new baseline
+
+Baselines are machine specific, regenerate it on the machine the benchmarks are compared on.
+"""
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(os.path.dirname(BENCHMARK_DIR), "app")
+BASELINE_PATH = os.path.join(BENCHMARK_DIR, "baseline.json")
+
+# cities of the benchmark gazetteer, so select_location_mdf never geocodes online
+CITIES = {"London": (51.51, -0.13), "Dhaka": (23.81, 90.41), "Sydney": (-33.87, 151.21)}
+
+SETTINGS = {
+    "full": {"years": (1980, 2009), "grid": (36, 72), "sizes": [3650, 10950], "windows": [1, 7, 31, 91], "edit_size": 3650, "repeat": 3},
+    "quick": {"years": (1980, 1999), "grid": (18, 36), "sizes": [1825, 3650], "windows": [1, 7, 31], "edit_size": 1825, "repeat": 1},
+}
+
+
+def offline_environment(data_dir):
+    '''
+    point the gazetteer and geocode cache at the benchmark data, must run before utils is imported
+    '''
+    gazetteer = os.path.join(data_dir, "gazetteer.csv")
+    with open(gazetteer, 'w') as f:
+        f.write("city,lat,lon\n")
+        for city, (lat, lon) in CITIES.items():
+            f.write("{},{},{}\n".format(city, lat, lon))
+    os.environ["CLIMATE_GAZETTEER"] = gazetteer
+    os.environ["CLIMATE_GEOCODE_CACHE"] = os.path.join(data_dir, "geocode_cache.json")
+    sys.path.insert(0, APP_DIR)
+    sys.path.insert(0, BENCHMARK_DIR)
+
+def best_time(function, repeat):
+    '''
+    fastest of repeat runs (seconds) and the result of the last run
+    '''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+def series(n, seed):
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    return (288 + 10 * np.sin(2 * np.pi * np.arange(n) / 365.25) + rng.normal(scale=3, size=n)).astype('f4')
+
+
+##################### benchmarks #####################
+
+def run_benchmarks(data_dir, settings):
+    import numpy as np
+    from synthetic import make_datasets
+    import utils
+    from climate_tasks import apply_bias_correction
+    from data import Data, DataLocationType, DataType
+
+    repeat = settings["repeat"]
+    start_year, end_year = settings["years"]
+    folders = make_datasets(data_dir, start_year, end_year, *settings["grid"])
+    start, end = "{}-01-01".format(start_year), "{}-12-31".format(end_year)
+    middle = "{}-12-31".format((start_year + end_year) // 2)
+    city = "London"
+
+    results = {}
+    def record(name, seconds, **info):
+        results[name] = {"seconds": round(seconds, 6), **info}
+        print("{:<45} {:>10.4f} s".format(name, seconds))
+
+    # calendar processing
+    seconds, reference = best_time(lambda: utils.process_reference(utils.import_reference(data_dir, folders["reference"])).load(), repeat)
+    record("process_reference", seconds)
+    reference_point = utils.select_location_mdf(reference, city, start, end).load()
+
+    for calendar in ["noleap", "360_day"]:
+        model = utils.import_dataset(data_dir, folders[calendar]).load()
+        seconds, processed = best_time(lambda: utils.process_models(model.copy(), reference_point), repeat)
+        record("process_models[{}]".format(calendar), seconds, time_steps=int(model.sizes["time"]))
+
+        seconds, selected = best_time(lambda: utils.select_location_mdf(processed, city, start, end).load(), repeat)
+        record("select_location_mdf[{}]".format(calendar), seconds)
+
+    # bias correction of the selected series
+    parameters = {"model": Data(DataType.MDF, DataLocationType.LOCAL, df=selected),
+                  "reference": Data(DataType.MDF, DataLocationType.LOCAL, df=reference_point),
+                  "past": [start, middle], "future": [middle, end], "bias_correction_method": "none"}
+    seconds, _ = best_time(lambda: apply_bias_correction(parameters), repeat)
+    record("apply_bias_correction[none]", seconds)
+
+    # reordering: N x window sweep
+    for n in settings["sizes"]:
+        A, B = series(n, 0), series(n, 1)
+        for window in settings["windows"]:
+            seconds, permutation = best_time(lambda: utils.reorder(A, B, window), repeat)
+            record("reorder[N={},window={}]".format(n, window), seconds, n=n, window=window)
+
+        B_matched = B[permutation]
+        for threshold_type, threshold in [("lower", np.quantile(A, 0.9)), ("upper", np.quantile(A, 0.1))]:
+            seconds, _ = best_time(lambda: utils.threshold_cost(A, B_matched, threshold, threshold_type), repeat)
+            record("threshold_cost[N={},{}]".format(n, threshold_type), seconds, n=n)
+
+    n = settings["edit_size"]
+    A, B = series(n, 0), series(n, 1)
+    seconds, _ = best_time(lambda: utils.threshold_cost(A, B, np.quantile(A, 0.9), "lower", "edit", 0.5, 7), repeat)
+    record("threshold_cost[N={},lower,edit]".format(n), seconds, n=n)
+
+    return results
+
+def metadata(mode):
+    import numpy as np
+    import xarray as xr
+    import scipy
+    return {"mode": mode, "created": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+            "numpy": np.__version__, "xarray": xr.__version__, "scipy": scipy.__version__,
+            "machine": platform.machine(), "cpus": os.cpu_count()}
+
+
+##################### baseline comparison #####################
+
+def compare(results, baseline, tolerance, min_seconds):
+    '''
+    returns [(name, seconds, baseline seconds, ratio)] of the cases slower than tolerance x baseline
+    '''
+    regressions = []
+    print("\n{:<45} {:>10} {:>10} {:>8}".format("benchmark", "seconds", "baseline", "ratio"))
+    for name, result in results.items():
+        if name not in baseline:
+            print("{:<45} {:>10.4f} {:>10} {:>8}".format(name, result["seconds"], "-", "new"))
+            continue
+        seconds, base = result["seconds"], baseline[name]["seconds"]
+        ratio = seconds / max(base, 1e-9)
+        regressed = ratio > tolerance and seconds - base > min_seconds
+        print("{:<45} {:>10.4f} {:>10.4f} {:>7.2f}x{}".format(name, seconds, base, ratio, "  REGRESSION" if regressed else ""))
+        if regressed:
+            regressions.append((name, seconds, base, ratio))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the processing and reordering hot paths on synthetic data')
+    parser.add_argument('--quick', action='store_true', help='smaller data and sweeps')
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), "climate-benchmark"), help='where the synthetic data is generated (reused between runs)')
+    parser.add_argument('--output', default='benchmark_results.json', help='results json')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--update-baseline', action='store_true', help='store the results as the baseline')
+    parser.add_argument('--tolerance', type=float, default=1.5, help='flag cases slower than tolerance x baseline')
+    parser.add_argument('--min-seconds', type=float, default=0.01, help='ignore slowdowns smaller than this')
+    args = parser.parse_args()
+
+    mode = "quick" if args.quick else "full"
+    settings = SETTINGS[mode]
+    data_dir = os.path.join(args.data_dir, "{}-{}_{}x{}".format(*settings["years"], *settings["grid"]))
+    os.makedirs(data_dir, exist_ok=True)
+    offline_environment(data_dir)
+
+    output = {"meta": metadata(mode), "results": run_benchmarks(data_dir, settings)}
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2)
+    print("\nResults written to {}".format(args.output))
+
+    if args.update_baseline:
+        baselines = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baselines = json.load(f)
+        baselines[mode] = output
+        with open(args.baseline, 'w') as f:
+            json.dump(baselines, f, indent=2)
+        print("Baseline ({}) updated: {}".format(mode, args.baseline))
+        sys.exit(0)
+
+    if not os.path.exists(args.baseline):
+        print("No baseline at {}, run with --update-baseline to create one".format(args.baseline))
+        sys.exit(0)
+    with open(args.baseline) as f:
+        baseline = json.load(f).get(mode)
+    if baseline is None:
+        print("No {} baseline in {}, run with --update-baseline to create one".format(mode, args.baseline))
+        sys.exit(0)
+
+    regressions = compare(output["results"], baseline["results"], args.tolerance, args.min_seconds)
+    if regressions:
+        print("\n{} regression(s) against the baseline of {}".format(len(regressions), baseline["meta"]["created"]))
+        sys.exit(1)
+    print("\nNo regressions against the baseline of {}".format(baseline["meta"]["created"]))
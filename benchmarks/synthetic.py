@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+import os
+import argparse
+import numpy as np
+import pandas as pd
+import xarray as xr
+import cftime
+
+"""
+Synthetic CMIP-like model and ERA5-like reference datasets for the benchmarks (no downloads needed).
+
+Models: daily 'tas' on a regular lat (-90 -> 90) / lon (0 -> 360) grid, cftime 'noleap' or '360_day' calendar
+with times at 12:00, one NetCDF file per decade as in the CMIP archives.
+Reference: daily 't2m' on an ERA5-style 'latitude' (90 -> -90) / 'longitude' grid with a standard calendar,
+i.e. it has to go through process_reference like the real ERA5 data.
+
+e.g.
+    python benchmarks/synthetic.py /tmp/climate-benchmark --years 1980 2009 --grid 36 72
+"""
+
+def grid(nlat, nlon):
+    lat = np.linspace(-90 + 90 / nlat, 90 - 90 / nlat, nlat)
+    lon = np.arange(nlon) * 360 / nlon
+    return lat, lon
+
+def temperatures(rng, day_of_year, year_length, lat, lon):
+    '''
+    seasonal cycle (stronger towards the poles) + latitude gradient + weather noise, in Kelvin
+    '''
+    seasonal = np.sin(2 * np.pi * (day_of_year[:, None, None] - 110) / year_length) * (5 + 10 * np.abs(np.sin(np.radians(lat)))[None, :, None])
+    mean = 300 - 40 * np.sin(np.radians(lat))[None, :, None] ** 2
+    noise = rng.normal(scale=3, size=(len(day_of_year), len(lat), len(lon)))
+    return (mean + np.sign(lat)[None, :, None] * seasonal + noise).astype('f4')
+
+def decades(start_year, end_year):
+    return [(year, min(year + 9, end_year)) for year in range(start_year, end_year + 1, 10)]
+
+def make_model(directory, calendar="noleap", start_year=1980, end_year=2009, nlat=36, nlon=72, seed=0):
+    '''
+    write a CMIP-like model (one file per decade) to directory, returns directory
+    '''
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    lat, lon = grid(nlat, nlon)
+    year_length = 360 if calendar == "360_day" else 365
+    for first, last in decades(start_year, end_year):
+        days = np.arange((last - first + 1) * year_length) + 0.5
+        times = cftime.num2date(days, "days since {}-01-01".format(first), calendar=calendar, only_use_cftime_datetimes=True)
+        day_of_year = np.array([t.dayofyr for t in times])
+        ds = xr.Dataset({"tas": (("time", "lat", "lon"), temperatures(rng, day_of_year, year_length, lat, lon))},
+                        coords={"time": times, "lat": lat, "lon": lon})
+        ds.time.encoding.update({"units": "days since 1850-01-01", "calendar": calendar})
+        ds.to_netcdf(os.path.join(directory, "tas_day_{}_{}-{}.nc".format(calendar, first, last)))
+    return directory
+
+def make_reference(directory, start_year=1980, end_year=2009, nlat=36, nlon=72, seed=1):
+    '''
+    write an ERA5-like reference (latitude/longitude/t2m, one file per decade) to directory, returns directory
+    '''
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    lat, lon = grid(nlat, nlon)
+    for first, last in decades(start_year, end_year):
+        times = pd.date_range("{}-01-01".format(first), "{}-12-31".format(last), freq="D")
+        t2m = temperatures(rng, times.dayofyear.values, 365.25, lat, lon)
+        ds = xr.Dataset({"t2m": (("time", "latitude", "longitude"), t2m[:, ::-1])},
+                        coords={"time": times, "latitude": lat[::-1], "longitude": lon})
+        ds.to_netcdf(os.path.join(directory, "era5_t2m_{}-{}.nc".format(first, last)))
+    return directory
+
+def make_datasets(directory, start_year=1980, end_year=2009, nlat=36, nlon=72):
+    '''
+    write models/noleap, models/360_day and reference/ERA5 under directory unless they exist
+    '''
+    folders = {"noleap": "models/noleap", "360_day": "models/360_day", "reference": "reference/ERA5"}
+    for name, folder in folders.items():
+        path = os.path.join(directory, folder)
+        if os.path.isdir(path) and os.listdir(path):
+            continue
+        print("Generating synthetic {} data in {}".format(name, path))
+        if name == "reference":
+            make_reference(path, start_year, end_year, nlat, nlon)
+        else:
+            make_model(path, name, start_year, end_year, nlat, nlon)
+    return folders
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generate synthetic model and reference datasets')
+    parser.add_argument('directory')
+    parser.add_argument('--years', nargs=2, type=int, default=[1980, 2009])
+    parser.add_argument('--grid', nargs=2, type=int, default=[36, 72], help='number of latitudes and longitudes')
+    args = parser.parse_args()
+    make_datasets(args.directory, args.years[0], args.years[1], *args.grid)
@@ -0,0 +1,89 @@
+import os
+import sys
+import pytest
+import boto3
+from moto import mock_aws
+
+"""
+download_s3_folder against a moto S3 bucket: nested keys, resumed downloads and failed downloads.
+"""
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app"))
+
+import clients
+import utils
+
+FILES = {
+    "models/EC-Earth3/tas_day_1990.nc": b"a" * 1000,
+    "models/EC-Earth3/historical/tas_day_1950.nc": b"b" * 2000,
+    "models/EC-Earth3/historical/r1i1p1f1/tas_day_1951.nc": b"c" * 3000,
+    "models/EC-Earth3/ssp585/r1i1p1f1/gr/tas_day_2050.nc": b"d" * 4000,
+}
+
+
+@pytest.fixture
+def bucket(monkeypatch):
+    for name in ["AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY", "AWS_SESSION_TOKEN"]:
+        monkeypatch.setenv(name, "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with mock_aws():
+        monkeypatch.setattr(clients, "_client", None) # created inside the mock
+        s3 = boto3.resource("s3")
+        bucket = s3.create_bucket(Bucket="climate-test")
+        for key, body in FILES.items():
+            bucket.put_object(Key=key, Body=body)
+        bucket.put_object(Key="models/EC-Earth3/historical/", Body=b"") # folder marker, skipped
+        yield bucket
+
+
+def local_files(directory):
+    return {os.path.relpath(os.path.join(root, name), directory): open(os.path.join(root, name), 'rb').read()
+            for root, dirs, files in os.walk(directory) for name in files if not name.startswith('.')}
+
+
+def test_nested_keys_downloaded_concurrently(bucket, tmp_path):
+    downloaded = utils.download_s3_folder(bucket, "models/EC-Earth3", local_dir=str(tmp_path), concurrency=4)
+
+    assert downloaded == sum(len(body) for body in FILES.values())
+    assert local_files(tmp_path) == {os.path.relpath(key, "models/EC-Earth3"): body for key, body in FILES.items()}
+
+
+def test_rerun_skips_complete_files(bucket, tmp_path, monkeypatch):
+    utils.download_s3_folder(bucket, "models/EC-Earth3", local_dir=str(tmp_path))
+    client = clients.s3_client()
+    calls = []
+    monkeypatch.setattr(client, "download_file", lambda *args, **kwargs: calls.append(args))
+
+    assert utils.download_s3_folder(bucket, "models/EC-Earth3", local_dir=str(tmp_path)) == 0
+    assert calls == []
+
+    # a changed object (new ETag) is downloaded again, the others are kept
+    bucket.put_object(Key="models/EC-Earth3/tas_day_1990.nc", Body=b"e" * 1000)
+    monkeypatch.undo()
+    assert utils.download_s3_folder(bucket, "models/EC-Earth3", local_dir=str(tmp_path)) == 1000
+    assert local_files(tmp_path)["tas_day_1990.nc"] == b"e" * 1000
+
+
+def test_failed_download_leaves_no_part_file(bucket, tmp_path, monkeypatch):
+    client = clients.s3_client()
+    download_file = client.download_file
+
+    def interrupted(bucket_name, key, filename, *args, **kwargs):
+        if key.endswith("tas_day_1950.nc"):
+            with open(filename, 'wb') as f:
+                f.write(b"partial")
+            raise ConnectionError("connection reset")
+        return download_file(bucket_name, key, filename, *args, **kwargs)
+
+    monkeypatch.setattr(client, "download_file", interrupted)
+    with pytest.raises(ConnectionError):
+        utils.download_s3_folder(bucket, "models/EC-Earth3", local_dir=str(tmp_path), concurrency=4)
+
+    names = [name for root, dirs, files in os.walk(tmp_path) for name in files]
+    assert not [name for name in names if name.endswith(".part")]
+    assert "tas_day_1950.nc" not in names
+
+    # the next run only fetches what is missing
+    monkeypatch.undo()
+    assert utils.download_s3_folder(bucket, "models/EC-Earth3", local_dir=str(tmp_path)) == 2000
+    assert local_files(tmp_path) == {os.path.relpath(key, "models/EC-Earth3"): body for key, body in FILES.items()}
@@ -0,0 +1,49 @@
+import io
+import os
+import sys
+import pytest
+import boto3
+import numpy as np
+import pandas as pd
+import xarray as xr
+from moto import mock_aws
+
+"""
+UploadQueue against a moto S3 bucket: csv and NetCDF outputs uploaded in the background.
+"""
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app"))
+
+import clients
+from uploads import UploadQueue
+
+
+@pytest.fixture
+def bucket(monkeypatch):
+    for name in ["AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY", "AWS_SESSION_TOKEN"]:
+        monkeypatch.setenv(name, "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with mock_aws():
+        monkeypatch.setattr(clients, "_client", None) # created inside the mock
+        yield boto3.resource("s3").create_bucket(Bucket="climate-test")
+
+
+def test_dataframe_and_dataset_uploads(bucket):
+    df = pd.DataFrame({"window": [1, 7], "cost": [1.4, 0.7]})
+    ds = xr.Dataset({"tas": ("time", np.arange(10.))})
+
+    queue = UploadQueue(concurrency=2)
+    queue.submit("s3://climate-test/outputs/costs-", df)
+    queue.submit("s3://climate-test/outputs/series-", ds)
+    uploaded = queue.flush()
+    queue.close()
+
+    assert len(uploaded) == 2
+    objects = {obj.key: obj for obj in bucket.objects.filter(Prefix="outputs/")}
+    csv_key = next(key for key in objects if key.endswith(".csv"))
+    nc_key = next(key for key in objects if key.endswith(".nc"))
+    assert csv_key.startswith("outputs/costs-") and nc_key.startswith("outputs/series-")
+
+    body = bucket.Object(csv_key).get()["Body"].read().decode()
+    assert pd.read_csv(io.StringIO(body), index_col=0).equals(df)
+    assert objects[nc_key].size > 0